@@ -1,6 +1,11 @@
 """
 Manifestly is a Python library for creating and managing manifest files.
 """
+import logging
+import ssl
+import warnings
+
+from manifestly import accel, settings
 from .core import Manifest
 
 __version__ = "0.2.4"
@@ -14,4 +19,18 @@ def get_version():
     return __version__
 
 
+if settings.USE_SHA_ACCELERATED is None:
+    settings.USE_SHA_ACCELERATED = accel.sha_accelerated()
+    if not settings.USE_SHA_ACCELERATED:
+        logging.getLogger(__name__).info(
+            "SHA extensions are not available (%s), hashing will use the portable implementation",
+            ssl.OPENSSL_VERSION
+        )
+    elif settings.DEFAULT_HASH_ALGORITHM == 'sha256':
+        # The CPU and OpenSSL version look right, make sure OpenSSL actually dispatches to the SHA extensions
+        _warning = accel.software_sha_warning()
+        if _warning:
+            settings.USE_SHA_ACCELERATED = False
+            warnings.warn(_warning, RuntimeWarning)
+
 __all__ = ["Manifest", "get_version"]
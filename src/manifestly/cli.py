@@ -6,8 +6,11 @@ Usage:
     manifestly sync <source_manifest> <target_manifest> <source_directory> <target_directory>
     manifestly compare <manifest1> <manifest2>
     manifestly patch <source_manifest> <target_manifest> <output_patch_file>
-    manifestly pzip <source_manifest> <target_manifest> <output_zip_file>
+    manifestly pzip <source_manifest> <target_manifest> <output_zip_file> [--store] [--dedupe]
+    manifestly punzip <zip_file> <directory>
 """
+import zipfile
+
 import click
 import fsspec
 
@@ -46,14 +49,17 @@ def generate_cmd(directory, hash_algorithm, output_file):
 @cli.command('changed')
 @click.argument('manifest')
 @click.option('--root', default=None)
-def changed_cmd(manifest, root):
+@click.option('--verify', is_flag=True, help="Re-hash files even if their size and mtime are unchanged.",
+              default=False)
+def changed_cmd(manifest, root, verify=False):
     """
     Print the files that have changed
     :param manifest: The manifest file
     :param root: The root directory
+    :param verify: Re-hash every file
     """
     m = Manifest(manifest, root=root)
-    _changed = m.changed()
+    _changed = m.changed(verify=verify)
     if not any(_changed.values()):
         click.echo('No files have changed')
         return
@@ -69,14 +75,17 @@ def changed_cmd(manifest, root):
 @cli.command('refresh')
 @click.argument('manifest')
 @click.option('--root', default=None)
-def refresh_cmd(manifest, root=None):
+@click.option('--verify', is_flag=True, help="Re-hash files even if their size and mtime are unchanged.",
+              default=False)
+def refresh_cmd(manifest, root=None, verify=False):
     """
     Refresh the manifest file
     :param manifest: The manifest file
     :param root: The root directory
+    :param verify: Re-hash every file
     """
     m = Manifest(manifest, root=root)
-    m.refresh()
+    m.refresh(verify=verify)
     click.echo("Manifest refreshed")
 
 
@@ -144,17 +153,37 @@ def patch_cmd(source_manifest, target_manifest, output_patch_file):
 @click.argument('source_manifest')
 @click.argument('target_manifest')
 @click.argument('output_zip_file')
-def pzip_cmd(source_manifest, target_manifest, output_zip_file):
+@click.option('--store', is_flag=True, help="Store files without compression (for already compressed files).",
+              default=False)
+@click.option('--dedupe', is_flag=True, help="Store files with identical content once (extract with punzip).",
+              default=False)
+def pzip_cmd(source_manifest, target_manifest, output_zip_file, store=False, dedupe=False):
     """
     Generate a zip file with the differences
     :param source_manifest: The source manifest file
     :param target_manifest: The target manifest file
     :param output_zip_file: Path to the output zip file
+    :param store: Store files without compression
+    :param dedupe: Store files with identical content once
     """
     s_manifest = Manifest(source_manifest)
-    s_manifest.pzip(target_manifest, output_zip_file)
+    s_manifest.pzip(target_manifest, output_zip_file,
+                    compression=zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED, dedupe=dedupe)
     click.echo(f"Zip file saved to {output_zip_file}")
 
 
+@cli.command('punzip')
+@click.argument('zip_file')
+@click.argument('directory')
+def punzip_cmd(zip_file, directory):
+    """
+    Extract the files of a zip file created by pzip
+    :param zip_file: The zip file
+    :param directory: The directory to extract the files to
+    """
+    Manifest.punzip(zip_file, directory)
+    click.echo(f"Files extracted to {directory}")
+
+
 if __name__ == '__main__':
     cli()  # pragma: no cover
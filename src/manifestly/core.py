@@ -5,18 +5,174 @@ This is the core module that provides the core functionality for generating, loa
 and syncing file manifests.
 """
 
+import base64
 import fnmatch
 import hashlib
 import json
-from itertools import chain
-from json import JSONDecodeError
-from typing import Union
+import mmap
+import ntpath
+import os
+import posixpath
+import re
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import chain, groupby
+from typing import Optional, Union
 
 import fsspec
 from fsspec.core import OpenFile
+from fsspec.implementations.local import LocalFileSystem
 
 from manifestly import settings
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import blake3
+except ImportError:  # pragma: no cover
+    blake3 = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+# Manifest files with this extension are stored as msgpack instead of JSON
+MSGPACK_SUFFIX = '.msgpack'
+# Characters that make an ignore pattern a glob rather than a plain file/directory name (fsspec globs paths with them)
+_GLOB_CHARS = frozenset('*?[')
+# fnmatch compares case-insensitively on platforms with case-insensitive paths (Windows)
+_CASE_INSENSITIVE = os.path.normcase('A') == 'a'
+# Name of the diff entry written into patch zips
+DIFF_NAME = '.manifestly.diff'
+# Layout of deduplicated patch zips: one .manifestly/objects/<hash> entry per unique file content and a
+# .manifestly/paths.json mapping. The zip comment marks the layout, so plain zips of any tree are never mistaken for it.
+OBJECTS_DIR = '.manifestly/objects'
+PATHS_NAME = '.manifestly/paths.json'
+DEDUPE_COMMENT = b'manifestly:dedupe'
+# Maximum number of files fetched with a single fs.cat call (bounds the memory used by pzip)
+_CAT_BATCH = 64
+# Number of small files hashed by a single thread pool task
+_HASH_BATCH = 32
+# Content checksums reported by object stores (S3/GCS/Azure) that change whenever a manifest file is rewritten
+_CHECKSUM_KEYS = ('ETag', 'etag', 'md5Hash', 'crc32c')
+# A file (or manifest without a checksum) modified this recently (in seconds) may be rewritten again within the same
+# mtime tick, so its modification time does not show the change (see Manifest.trusted_stat)
+_RACY_MTIME = 1.0
+# Empty hashlib objects by algorithm, new hashers are copied from these (see new_hasher)
+_HASHER_PROTOTYPES = {}
+
+
+def fspath(path):
+    """
+    Convert an os.PathLike path (such as a pathlib.Path) to a string, any other value is returned unchanged
+    :param path: The path (a string, an os.PathLike object or an fsspec.core.OpenFile)
+    :return: The path
+    """
+    if isinstance(path, os.PathLike):
+        return os.fspath(path)
+    return path
+
+
+def tree_order(path: str) -> tuple:
+    """
+    Sort key that orders relative paths by (directory, name), so the files of a directory are processed together
+    :param path: The relative file path
+    :return: Tuple of (directory, name)
+    """
+    directory, _, name = path.rpartition('/')
+    return directory, name
+
+
+def dump_json(data, f):
+    """
+    Write JSON to a file, with sorted keys so that manifests are deterministic and diff well.
+    Uses orjson when it is installed. Both encoders build the document first and write it with a single call,
+    as every write to an fsspec file goes through Python level buffering.
+    :param data: The data to write
+    :param f: The (binary mode) file object
+    """
+    if orjson is not None:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+        return
+    # Manifests are plain dictionaries of strings, so skip the circular reference bookkeeping
+    f.write(json.dumps(data, indent=2, check_circular=False, sort_keys=True).encode('utf-8'))
+
+
+def _require_msgpack():
+    if msgpack is None:
+        # Not a ValueError, so load() does not mistake it for a corrupt manifest
+        raise ImportError(f'{MSGPACK_SUFFIX} manifests require the msgpack package (pip install "manifestly[msgpack]")')
+
+
+def dump_manifest(data: dict, f, path: str):
+    """
+    Write a serialized manifest, as msgpack if the path ends with .msgpack and as JSON otherwise
+    :param data: The serialized manifest
+    :param f: The (binary mode) file object
+    :param path: The path of the manifest file
+    """
+    if path.endswith(MSGPACK_SUFFIX):
+        _require_msgpack()
+        f.write(msgpack.packb(data))
+        return
+    dump_json(data, f)
+
+
+def load_manifest(data: bytes, path: str) -> dict:
+    """
+    Parse a serialized manifest, as msgpack if the path ends with .msgpack and as JSON otherwise
+    :param data: The file contents
+    :param path: The path of the manifest file
+    :return: The serialized manifest
+    """
+    if path.endswith(MSGPACK_SUFFIX):
+        _require_msgpack()
+        return msgpack.unpackb(data, raw=False)
+    return load_json(data)
+
+
+def load_json(data: bytes):
+    """
+    Parse JSON, using orjson when it is installed
+    :param data: The JSON document
+    :return: The parsed data
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def new_hasher(algorithm: str = settings.DEFAULT_HASH_ALGORITHM):
+    """
+    Create a new hash object.
+    Manifest hashes are used for change detection, not security, so this lets OpenSSL pick its
+    fastest (SHA-NI / ARMv8 accelerated) implementation even on FIPS restricted builds.
+    :param algorithm: The hash algorithm to use
+    :return: The hash object
+    """
+    if algorithm == 'blake3':
+        if blake3 is None:
+            raise ValueError('The blake3 hash algorithm requires the blake3 package (pip install "manifestly[blake3]")')
+        # The Rust implementation hashes large inputs on multiple threads
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    proto = _HASHER_PROTOTYPES.get(algorithm)
+    if proto is None:
+        try:
+            proto = hashlib.new(algorithm, usedforsecurity=False)
+        except TypeError:
+            # Python < 3.9 does not support usedforsecurity
+            proto = hashlib.new(algorithm)
+        _HASHER_PROTOTYPES[algorithm] = proto
+    # Copying an empty hasher skips the name lookup and setup of hashlib.new (~4x faster per file)
+    return proto.copy()
+
 
 class ManifestlyIgnore:
     """
@@ -24,23 +180,74 @@ class ManifestlyIgnore:
     You can specify files or directories to ignore.
     This loads the .manifestlyignore file and provides a method to check if a file should be ignored.
     """
+    __slots__ = ('ignore_file', 'ignore_patterns', '_compiled_patterns', '_stripped_patterns', '_ignore_names',
+                 '_ignore_regex', '_dir_ignored')
 
-    def __init__(self, ignore_file: Union[str, OpenFile]):
+    def __init__(self, ignore_file: Union[str, os.PathLike, OpenFile]):
+        ignore_file = fspath(ignore_file)
         if isinstance(ignore_file, str):
             ignore_file = fsspec.open(ignore_file, 'r')
         self.ignore_file = ignore_file
         self.ignore_patterns = self.load_ignore_patterns()
+        self.compile_ignore_patterns()
 
     def load_ignore_patterns(self):
         """
-        Load the ignore patterns from the .manifestlyignore file
+        Load the ignore patterns from the .manifestlyignore file.
+        Blank lines and comments (lines starting with #) are skipped.
         """
         ignore = [settings.MANIFEST_NAME]
         try:
-            with self.ignore_file.open() as f:
-                return ignore + [self.normalize_path(p) for p in f.read().splitlines()]
+            with self.ignore_file.fs.open(self.ignore_file.path, 'rb') as f:
+                data = f.read()
         except FileNotFoundError:
             return ignore
+        return ignore + [
+            self.normalize_path(p.decode('utf-8')) for p in data.splitlines() if p.strip() and not p.startswith(b'#')
+        ]
+
+    def compile_ignore_patterns(self):
+        """
+        Compile the ignore patterns.
+        Plain names are matched with a set lookup and all glob patterns are combined into a single regular
+        expression, so checking a path segment no longer loops over (and recompiles) every pattern.
+        should_ignore recompiles when ignore_patterns is changed or replaced.
+        """
+        # The patterns the matchers were built from (a copy, so changes to ignore_patterns are noticed)
+        self._compiled_patterns = list(self.ignore_patterns)
+        # ignore_patterns keeps the patterns as written, matching only needs them stripped once
+        self._stripped_patterns = [p.strip('/') for p in self.ignore_patterns]
+        names = set()
+        globs = []
+        for _pattern in self._stripped_patterns:
+            if _CASE_INSENSITIVE:
+                _pattern = _pattern.lower()
+            if _GLOB_CHARS.isdisjoint(_pattern):
+                names.add(_pattern)
+            else:
+                globs.append(f'(?:{fnmatch.translate(_pattern)})')
+        self._ignore_names = names
+        self._ignore_regex = re.compile('|'.join(globs)) if globs else None
+        # Files in the same directory share the decision for their parent directories
+        self._dir_ignored = lru_cache(maxsize=4096)(self._check_dir_ignored)
+
+    def _matches(self, name: str) -> bool:
+        """
+        Check if a single path segment matches an ignore pattern
+        :param name: The file or directory name
+        :return: True if the name matches a pattern
+        """
+        return name in self._ignore_names or (self._ignore_regex is not None and bool(self._ignore_regex.match(name)))
+
+    def _check_dir_ignored(self, dir_path: str) -> bool:
+        """
+        Check if a directory or any of its parent directories matches an ignore pattern.
+        Called through the cached self._dir_ignored.
+        :param dir_path: The normalized directory path
+        :return: True if the directory is ignored
+        """
+        parent, sep, name = dir_path.rpartition('/')
+        return self._matches(name) or (bool(sep) and self._dir_ignored(parent))
 
     def should_ignore(self, file_path: str) -> bool:
         """
@@ -48,16 +255,15 @@ class ManifestlyIgnore:
         :param file_path: The path to the file.
         :return: True if the file should be ignored, False otherwise.
         """
+        if self.ignore_patterns != self._compiled_patterns:
+            # The patterns were modified directly
+            self.compile_ignore_patterns()
         # Normalize the file path to always use forward slashes
         normalized_path = self.normalize_path(file_path)
-
-        for pattern in self.ignore_patterns:
-            _pattern = pattern.strip('/')
-
-            if any(fnmatch.fnmatch(part, _pattern) for part in normalized_path.split('/')):
-                return True
-
-        return False
+        if _CASE_INSENSITIVE:
+            normalized_path = normalized_path.lower()
+        parent, sep, name = normalized_path.rpartition('/')
+        return self._matches(name) or (bool(sep) and self._dir_ignored(parent))
 
     @staticmethod
     def normalize_path(path: str) -> str:
@@ -75,21 +281,31 @@ class ManifestlyIgnore:
         """
         if isinstance(name, OpenFile):
             name = self.normalize_path(name.path).split('/')[-1]
+        else:
+            name = self.normalize_path(name)
         if name not in self.ignore_patterns:
-            self.ignore_patterns.append(self.normalize_path(name))
+            # Compiled on the next should_ignore call
+            self.ignore_patterns.append(name)
 
 
 class Manifest:
     """
     A class to represent a manifest
     """
+    __slots__ = ('manifest_file', 'manifest', 'stats', 'ignore', '_root', '_root_fs', '_loaded_stat')
 
-    def __init__(self, manifest_file: Union[str, OpenFile], manifest: dict = None,
-                 root: str = None, ignore: ManifestlyIgnore = None):
+    def __init__(self, manifest_file: Union[str, os.PathLike, OpenFile], manifest: dict = None,
+                 root: Union[str, os.PathLike] = None, ignore: ManifestlyIgnore = None, stats: dict = None):
+        manifest_file = fspath(manifest_file)
         if isinstance(manifest_file, str):
             manifest_file = fsspec.open(manifest_file)
         self.manifest_file: OpenFile = manifest_file
         self.manifest: dict = manifest
+        # Size and modification time of the files when they were hashed (used to skip re-hashing)
+        self.stats: dict = stats if stats is not None else {}
+        self._root_fs = None
+        # Size and mtime of the manifest file when it was last loaded (see load)
+        self._loaded_stat = None
         self.root = root
         if self.manifest is None:
             self.load()
@@ -97,21 +313,138 @@ class Manifest:
             ignore = ManifestlyIgnore(self.default_ignore_file(self.root))
         self.ignore = ignore
 
+    @property
+    def root(self):
+        """
+        The root directory of the manifest
+        """
+        return self._root
+
+    @root.setter
+    def root(self, root):
+        self._root = fspath(root)
+        # Resolved lazily by root_fs
+        self._root_fs = None
+
+    @property
+    def root_fs(self) -> tuple:
+        """
+        The filesystem and path of the root directory.
+        This is resolved once per root instead of calling url_to_fs in every method.
+        Without a root, the directory of the manifest file is used.
+        :return: Tuple of (filesystem, path)
+        """
+        if self.root is None:
+            self._resolve_root()
+        if self._root_fs is None:
+            self._root_fs = fsspec.core.url_to_fs(self.root)
+        return self._root_fs
+
     def _reopen(self, mode='r'):
-        return fsspec.open(self.manifest_file.path, mode)
+        # Reuse the filesystem of the manifest file rather than parsing the path again
+        return OpenFile(self.manifest_file.fs, self.manifest_file.path, mode)
 
     def save(self):
         """
         Save the manifest to a file
         :param file_path: The path to the manifest file
         """
-        _file = self._reopen('w')
+        _file = self._reopen('wb')
         # Make sure directories exist
         _file.fs.makedirs(_file.fs._parent(_file.path), exist_ok=True)
 
         with _file.open() as f:
             f.seek(0)
-            json.dump(self.manifest, f, indent=2)
+            dump_manifest(self._serialize(self.manifest, self.stats), f, _file.path)
+
+    @staticmethod
+    def _serialize(manifest: dict, stats: dict) -> dict:
+        """
+        Convert a manifest to its on disk format.
+        Files with known stats are stored as {"hash": ..., "size": ..., "mtime": ...}, other files as the bare hash.
+        :param manifest: Dictionary of files to hashes
+        :param stats: Dictionary of files to size and mtime
+        :return: The data to store
+        """
+        if not stats:
+            return manifest
+        data = {}
+        for file, _hash in manifest.items():
+            _stat = stats.get(file)
+            data[file] = {'hash': _hash, **_stat} if _stat else _hash
+        return data
+
+    @staticmethod
+    def _deserialize(data: dict) -> tuple:
+        """
+        Split the on disk format into the manifest (files to hashes) and the file stats
+        :param data: The stored data
+        :return: Tuple of (manifest, stats)
+        :raises ValueError: If the data is not a manifest
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f'A manifest must be a mapping, not {type(data).__name__}')
+        manifest = {}
+        stats = {}
+        for file, entry in data.items():
+            if isinstance(entry, dict):
+                if 'hash' not in entry:
+                    raise ValueError(f'The manifest entry for {file} has no hash')
+                manifest[file] = entry['hash']
+                if 'size' in entry and 'mtime' in entry:
+                    stats[file] = {'size': entry['size'], 'mtime': entry['mtime']}
+            else:
+                manifest[file] = entry
+        return manifest, stats
+
+    @staticmethod
+    def file_stat(info: dict) -> Optional[dict]:
+        """
+        Get the size and modification time of a file from its fsspec info
+        :param info: The info dictionary (from fs.info or fs.find(detail=True))
+        :return: Dictionary with size and mtime, or None if the filesystem does not provide them
+        """
+        size = info.get('size')
+        mtime = info.get('mtime', info.get('LastModified', info.get('last_modified')))
+        if hasattr(mtime, 'timestamp'):
+            mtime = mtime.timestamp()
+        if size is None or not isinstance(mtime, (int, float)):
+            return None
+        return {'size': size, 'mtime': mtime}
+
+    @classmethod
+    def manifest_fingerprint(cls, info: dict) -> Optional[tuple]:
+        """
+        Get a fingerprint of the manifest file that changes whenever the file is rewritten (used by load).
+        A rewritten manifest usually keeps its size, so the modification time alone is not trusted when it is so
+        recent that another write within the same tick (1 second on S3, FAT and HFS+) would keep it, like git's racy
+        timestamps.
+        :param info: The info dictionary of the manifest file (from fs.info)
+        :return: Tuple of (size, mtime, checksum), or None if the file may have changed without a new fingerprint
+        """
+        _stat = cls.file_stat(info)
+        if _stat is None:
+            return None
+        checksum = next((info[key] for key in _CHECKSUM_KEYS if info.get(key)), None)
+        if checksum is None and time.time() - _stat['mtime'] < _RACY_MTIME:
+            return None
+        return _stat['size'], _stat['mtime'], checksum
+
+    @classmethod
+    def trusted_stat(cls, info: dict, listed: float) -> Optional[dict]:
+        """
+        Get the size and modification time of a file if they can be trusted to detect changes.
+        A file modified within _RACY_MTIME of the listing may be rewritten again in the same mtime tick (1 second on
+        S3, FAT and HFS+) without a new size or modification time, so its stats are neither recorded nor trusted and
+        the file is hashed again next time.
+        :param info: The info dictionary (from fs.info or fs.find(detail=True))
+        :param listed: The time the info was listed (time.time())
+        :return: Dictionary with size and mtime, or None
+        """
+        _stat = cls.file_stat(info)
+        if _stat is None or listed - _stat['mtime'] < _RACY_MTIME:
+            return None
+        return _stat
 
     def items(self):
         """
@@ -152,38 +485,58 @@ class Manifest:
         """
         return item in self.manifest
 
-    def load(self):
+    def load(self, force=True):
         """
         Load a manifest from a file
+        :param force: Always read the file. Otherwise, the load is skipped if the manifest file has not changed since
+            it was last loaded.
         :return: The loaded manifest
         """
+        fs, path = self.manifest_file.fs, self.manifest_file.path
+        # A single info call tells whether the manifest exists, if it is a directory and when it last changed
         try:
-            with self._reopen() as f:
-                _data = f.read()
-                if not _data:
-                    self.manifest = {}
-                else:
-                    self.manifest = json.loads(_data)
+            info = fs.info(path)
         except FileNotFoundError:
+            info = None
+        if info is None:
+            self._loaded_stat = None
             self.manifest = {}
             self.save()
-        except IsADirectoryError:
+        elif info['type'] == 'directory':
             # The manifest file is a directory, so we need to append the default manifest file name
+            self._loaded_stat = None
             self.root = self.manifest_file
             self.manifest_file = self.default_manifest_file(self.manifest_file)
             self.load()
-        except JSONDecodeError:
-            self.manifest = {}
+        else:
+            _stat = self.manifest_fingerprint(info)
+            if not force and _stat is not None and _stat == self._loaded_stat:
+                return
+            self._loaded_stat = _stat
+            _data = fs.cat_file(path)
+            try:
+                self.manifest, self.stats = self._deserialize(load_manifest(_data, path)) if _data else ({}, {})
+            except ValueError:
+                # JSONDecodeError, a msgpack unpacking error or data that is not a manifest
+                self.manifest = {}
+                self.stats = {}
         if self.root is None:
-            # Resolve the root path from the manifest file
-            fs, path = fsspec.core.url_to_fs(self.manifest_file.path)
-            self.root = fs._parent(path)
+            self._resolve_root()
+
+    def _resolve_root(self):
+        """
+        Set the root directory to the directory containing the manifest file
+        """
+        fs = self.manifest_file.fs
+        self.root = fs._parent(self.manifest_file.path)
+        # The root is on the same filesystem as the manifest file
+        self._root_fs = (fs, self.root)
 
     @classmethod
-    def default_manifest_file(cls, directory: Union[str, OpenFile]) -> OpenFile:
+    def default_manifest_file(cls, directory: Union[str, os.PathLike, OpenFile]) -> OpenFile:
         """
         Get the default manifest file for a directory.
-        The directory must be a string or an fsspec.core.OpenFile object.
+        The directory must be a string, an os.PathLike object or an fsspec.core.OpenFile object.
 
         :param directory: The directory
         :return: The path to the manifest file
@@ -193,10 +546,10 @@ class Manifest:
         return fsspec.open(manifest_path)
 
     @classmethod
-    def default_ignore_file(cls, directory: Union[str, OpenFile]) -> OpenFile:
+    def default_ignore_file(cls, directory: Union[str, os.PathLike, OpenFile]) -> OpenFile:
         """
         Get the default manifest file for a directory.
-        The directory must be a string or an fsspec.core.OpenFile object.
+        The directory must be a string, an os.PathLike object or an fsspec.core.OpenFile object.
 
         :param directory: The directory
         :return: The path to the manifest file
@@ -206,8 +559,10 @@ class Manifest:
         return fsspec.open(manifest_path, 'r')
 
     @classmethod
-    def generate(cls, directory, manifest_file: Union[str, OpenFile] = None, root_path: str = None,
-                 hash_algorithm=settings.DEFAULT_HASH_ALGORITHM, ignore: ManifestlyIgnore = None) -> 'Manifest':
+    def generate(cls, directory, manifest_file: Union[str, os.PathLike, OpenFile] = None,
+                 root_path: Union[str, os.PathLike, OpenFile] = None,
+                 hash_algorithm=settings.DEFAULT_HASH_ALGORITHM, ignore: ManifestlyIgnore = None,
+                 previous: 'Manifest' = None, workers: int = None) -> 'Manifest':
         """
         Generate a manifest for a directory
         :param directory: The directory to generate the manifest for
@@ -215,9 +570,14 @@ class Manifest:
         :param root_path: The root path to use (all paths will be relative to this)
         :param hash_algorithm: Hash algorithm to use
         :param ignore: The ignore file
+        :param previous: A previous manifest of the same directory (and hash algorithm). Hashes of files whose size
+            and modification time did not change are reused instead of hashing the files again.
+        :param workers: Number of threads used to hash files (defaults to settings.HASH_WORKERS)
         :return: The generated manifest
         """
-        manifest = {}
+        directory = fspath(directory)
+        manifest_file = fspath(manifest_file)
+        root_path = fspath(root_path)
         fs, path = fsspec.core.url_to_fs(directory)
         if root_path is None:
             root_path = path
@@ -236,50 +596,103 @@ class Manifest:
             _ignore_file = _ignore_file.split('/')[-1].split('\\')[-1]
             ignore.add_ignore_pattern(_ignore_file)
 
-        for file_path in fs.find(path):
-            if fs.isfile(file_path):
-                # Check ignore patterns
-                if ignore.should_ignore(file_path):
-                    continue
-                relative_path = file_path[len(root_path):].lstrip('/')
-                manifest[relative_path] = cls.calculate_hash(fs.open(file_path), algorithm=hash_algorithm)
+        files, infos, stats = cls._list_files(fs, path, root_path, ignore)
+        known = cls._known_hashes(previous, stats)
+        manifest = cls.hash_files(fs, files, algorithm=hash_algorithm, infos=infos, known=known, workers=workers)
 
         if manifest_file:
             if not isinstance(manifest_file, OpenFile):
-                manifest_file = fsspec.open(manifest_file, 'w')
-            elif 'w' not in manifest_file.mode:
-                manifest_file = fsspec.open(manifest_file.path, 'w')
+                manifest_file = fsspec.open(manifest_file, 'wb')
+            elif manifest_file.mode != 'wb':
+                manifest_file = OpenFile(manifest_file.fs, manifest_file.path, 'wb')
             with manifest_file as f:
-                json.dump(manifest, f, indent=2)
-        return cls(manifest_file, manifest, root=root_path, ignore=ignore)
+                dump_manifest(cls._serialize(manifest, stats), f, manifest_file.path)
+        return cls(manifest_file, manifest, root=root_path, ignore=ignore, stats=stats)
 
-    def changed(self) -> dict:
+    @classmethod
+    def _list_files(cls, fs, path: str, root_path: str, ignore: ManifestlyIgnore = None) -> tuple:
+        """
+        List the files below a directory.
+        A single detailed listing avoids a stat/round trip per file.
+        :param fs: The filesystem
+        :param path: The directory to list
+        :param root_path: The root path (the returned paths are relative to it)
+        :param ignore: Skip the files it ignores
+        :return: Tuple of (files, infos, stats) dictionaries keyed by relative path, to the full paths, the fsspec
+            infos and the trusted stats (see trusted_stat)
+        """
+        files = {}
+        infos = {}
+        stats = {}
+        # Strip the root (and its separator) from every file path
+        prefix_len = len(root_path) + (0 if root_path.endswith('/') else 1)
+        listed = time.time()
+        for file_path, info in fs.find(path, detail=True).items():
+            if info['type'] != 'file' or (ignore is not None and ignore.should_ignore(file_path)):
+                continue
+            relative_path = file_path[prefix_len:]
+            files[relative_path] = file_path
+            infos[relative_path] = info
+            _stat = cls.trusted_stat(info, listed)
+            if _stat:
+                stats[relative_path] = _stat
+        return files, infos, stats
+
+    @staticmethod
+    def _known_hashes(previous: Optional['Manifest'], stats: dict) -> dict:
+        """
+        Get the hashes of a previous manifest that can be reused
+        :param previous: The previous manifest (or None)
+        :param stats: The trusted stats of the listed files (see trusted_stat)
+        :return: Dictionary of relative paths to hashes for the files whose size and modification time did not change
+        """
+        if previous is None:
+            return {}
+        return {
+            relative_path: previous.manifest[relative_path] for relative_path, _stat in stats.items()
+            if relative_path in previous.manifest and previous.stats.get(relative_path) == _stat
+        }
+
+    def changed(self, verify=False, reload=False) -> dict:
         """
         Get the files that have changed
-        This returns a dictionary of added, removed, and changed files
+        This returns a dictionary of added, removed, and changed files.
+        Files whose size and (non racy, see trusted_stat) modification time match the manifest are not re-hashed unless
+        verify is set.
+        :param verify: Re-hash every file, even if its size and modification time are unchanged. This is the only
+            mode that checks the content of every file.
+        :param reload: Reload the manifest file first (if it changed on disk since it was loaded)
         :return: Dictionary of changed files
         """
-        self.load()
-        fs, path = fsspec.core.url_to_fs(self.root)
+        if reload:
+            self.load(force=False)
+        fs, path = self.root_fs
         changed = {
             'added': {},
             'removed': {},
             'changed': {}
         }
+        # List the tree once and derive removed, changed and added files from it
+        files, infos, stats = self._list_files(fs, path, path)
+        existing = {}
         for file, _hash in self.manifest.items():
-            file_path = f'{path}/{file}'
-            if not fs.exists(file_path):
+            if file not in files:
                 changed['removed'][file] = _hash
                 continue
-            _new_hash = self.calculate_hash(fs.open(file_path))
-            if _hash != _new_hash:
+            _stat = self.stats.get(file)
+            if not verify and _stat and _stat == stats.get(file):
+                # Same size and modification time, skip hashing
+                continue
+            existing[file] = files[file]
+        for file, _new_hash in self.hash_files(fs, existing, infos=None if verify else infos).items():
+            if self.manifest[file] != _new_hash:
                 changed['changed'][file] = _new_hash
-        for file in fs.find(path):
-            if self.ignore.should_ignore(file):
+        added = {}
+        for relative_path, file_path in files.items():
+            if relative_path in self.manifest or self.ignore.should_ignore(file_path):
                 continue
-            relative_path = file[len(path):].lstrip('/')
-            if relative_path not in self.manifest:
-                changed['added'][relative_path] = self.calculate_hash(fs.open(file))
+            added[relative_path] = file_path
+        changed['added'] = self.hash_files(fs, added, infos=infos)
         return changed
 
     def sync(self, target_manifest, dry_run=False) -> 'Manifest':
@@ -288,17 +701,18 @@ class Manifest:
         :param target_manifest: The path to the target manifest file or a Manifest object
         :param dry_run: Perform a dry run
         """
-        if isinstance(target_manifest, str):
+        if not isinstance(target_manifest, Manifest):
             target_manifest = Manifest(target_manifest)
         diff = self.diff(target_manifest)
 
-        fs_source, source_path = fsspec.core.url_to_fs(self.root)
-        fs_target, target_path = fsspec.core.url_to_fs(target_manifest.root)
+        fs_source, source_path = self.root_fs
+        fs_target, target_path = target_manifest.root_fs
 
-        for file in chain(diff['added'].keys(), diff['changed'].keys()):
+        copies = []
+        # Copy directory by directory for better read locality and prefetching
+        for file in sorted(chain(diff['added'].keys(), diff['changed'].keys()), key=tree_order):
             source_file = f'{source_path}/{file}'
             target_file = f'{target_path}/{file}'
-            fs_target.mkdirs(fs_target._parent(target_file), exist_ok=True)
             # Check if the file still exists before copying
             if not fs_source.exists(source_file):
                 print(f'File {source_file} does not exist')
@@ -307,35 +721,47 @@ class Manifest:
             if dry_run:
                 print(f'Copy {source_file} to {target_file}')
                 continue
-            with fs_source.open(source_file, 'rb') as src, fs_target.open(target_file, 'wb') as tgt:
-                tgt.write(src.read())
+            copies.append((source_file, target_file))
 
+        # Create each target directory once, not once per file
+        for parent in sorted({fs_target._parent(target_file) for _, target_file in copies}):
+            fs_target.mkdirs(parent, exist_ok=True)
+        self._copy_files(fs_source, fs_target, copies)
+
+        removals = []
         for file in diff['removed']:
             target_file = f'{target_path}/{file}'
             if fs_target.exists(target_file):
                 if dry_run:
                     print(f'Remove {target_file}')
                     continue
-                fs_target.rm(target_file)
+                removals.append(target_file)
+        # fs.rm expands glob characters, so names like pages/[id].tsx are removed one by one with rm_file
+        for target_file in [file for file in removals if not _GLOB_CHARS.isdisjoint(file)]:
+            fs_target.rm_file(target_file)
+        removals = [file for file in removals if _GLOB_CHARS.isdisjoint(file)]
+        if removals:
+            # A single bulk delete instead of a request per file
+            fs_target.rm(removals)
 
         if not dry_run:
             # Regenerate the target manifest
             target_manifest.refresh()
         return target_manifest
 
-    def refresh(self):
+    def refresh(self, verify=False):
         """
         Regenerate the manifest
+        Files whose size and modification time did not change keep their hash unless verify is set.
+        :param verify: Re-hash every file
         """
-        self.manifest = {}
+        if self.root is None:
+            self._resolve_root()
         directory = self.root
-        if directory is None:
-            # Resolve the directory from the manifest file
-            fs, path = fsspec.core.url_to_fs(self.manifest_file)  # noqa
-            directory = fs._parent(path)  # noqa
         _m = self.generate(directory=directory, manifest_file=self.manifest_file, root_path=self.root,
-                           ignore=self.ignore)
+                           ignore=self.ignore, previous=None if verify else self)
         self.manifest = _m.manifest
+        self.stats = _m.stats
 
     def diff(self, target_manifest) -> dict:
         """
@@ -345,20 +771,16 @@ class Manifest:
         """
         if not isinstance(target_manifest, Manifest):
             target_manifest = Manifest(target_manifest)
-        diff = {
-            'added': {},
-            'removed': {},
-            'changed': {}
+        source, target = self.manifest, target_manifest.manifest
+        # Key views support set operations in C, sort the (usually small) results for a stable output
+        source_keys, target_keys = source.keys(), target.keys()
+        return {
+            'added': {file: source[file] for file in sorted(source_keys - target_keys)},
+            'removed': {file: target[file] for file in sorted(target_keys - source_keys)},
+            'changed': {file: source[file] for file in sorted(
+                file for file in source_keys & target_keys if source[file] != target[file]
+            )}
         }
-        for file, _hash in self.items():
-            if file not in target_manifest.manifest:
-                diff['added'][file] = _hash
-            elif target_manifest.manifest[file] != _hash:
-                diff['changed'][file] = _hash
-        for file, _hash in target_manifest.items():
-            if file not in self.manifest:
-                diff['removed'][file] = _hash
-        return diff
 
     def patch(self, target_manifest, output_patch_file) -> dict:
         """
@@ -370,42 +792,414 @@ class Manifest:
         if not isinstance(target_manifest, Manifest):
             target_manifest = Manifest(target_manifest)
         diff = self.diff(target_manifest)
-        with fsspec.open(output_patch_file, 'w') as f:
-            json.dump(diff, f, indent=2)
+        with fsspec.open(output_patch_file, 'wb') as f:
+            dump_json(diff, f)
         return diff
 
-    def pzip(self, target_manifest, output_zip_file):
+    def pzip(self, target_manifest, output_zip_file, compression=zipfile.ZIP_DEFLATED, compresslevel=1, dedupe=False):
         """
         Generate a zip file containing the files that need to be added or updated to make the target manifest match
         :param target_manifest: The path to the target manifest file or a Manifest object
         :param output_zip_file: The path to the output zip file
+        :param compression: The zip compression method (use zipfile.ZIP_STORED for already compressed files)
+        :param compresslevel: The compression level (defaults to the fastest)
+        :param dedupe: Store files with identical content once, as .manifestly/objects/<hash> entries with a
+            .manifestly/paths.json mapping of file paths to hashes (see punzip)
         """
-        import zipfile
         if not isinstance(target_manifest, Manifest):
             target_manifest = Manifest(target_manifest)
         diff = self.diff(target_manifest)
-        fs, _ = fsspec.core.url_to_fs('')
+        fs, path = self.root_fs
+        # Read the files directory by directory for better locality and prefetching
+        files = dict(chain(diff['added'].items(), diff['changed'].items()))
+        files = {file: files[file] for file in sorted(files, key=tree_order)}
+        if dedupe:
+            # Store the first file with each hash
+            unique = {}
+            for file, _hash in files.items():
+                unique.setdefault(_hash, (f'{OBJECTS_DIR}/{_hash}', file))
+            entries = list(unique.values())
+        else:
+            entries = [(file, file) for file in files]
         with fsspec.open(output_zip_file, 'wb') as zf:
-            with zipfile.ZipFile(zf, 'w') as zipf:
-                for file in chain(diff['added'].keys(), diff['changed'].keys()):
-                    # resolve the full path from the root
-                    _fpath = f'{self.root}/{file}'
-                    with fs.open(_fpath, 'rb') as f:
-                        zipf.writestr(file, f.read())
-                # Create a '.manifestly.diff' of the diff contents
-                with fsspec.open('.manifestly.diff', 'w') as f:
-                    f.write(json.dumps(diff))
+            with zipfile.ZipFile(zf, 'w', compression=compression, compresslevel=compresslevel) as zipf:
+                for batch in self._directory_batches(entries):
+                    # Fetch small remote files with one batched request instead of a round trip per file
+                    small = [f'{path}/{file}' for _, file in batch if self._is_small_remote(fs, file)]
+                    data = fs.cat(small) if small else {}
+                    for name, file in batch:
+                        # resolve the full path from the root
+                        _fpath = f'{path}/{file}'
+                        if _fpath in data:
+                            zipf.writestr(name, data.pop(_fpath))
+                            continue
+                        # Stream the file into the zip so memory use does not depend on the file size
+                        with self.open_sequential(fs, _fpath) as src, zipf.open(name, 'w', force_zip64=True) as dst:
+                            shutil.copyfileobj(src, dst, settings.CHUNK_SIZE)
+                if dedupe:
+                    zipf.writestr(PATHS_NAME, json.dumps(files))
+                    zipf.comment = DEDUPE_COMMENT
+                # Include a '.manifestly.diff' of the diff contents in the zip
+                zipf.writestr(DIFF_NAME, json.dumps(diff))
 
     @staticmethod
-    def calculate_hash(file: OpenFile, algorithm=settings.DEFAULT_HASH_ALGORITHM):
+    def punzip(zip_file, directory):
+        """
+        Extract the files of a zip created by pzip into a directory (both plain and deduplicated zips)
+        :param zip_file: The path to the zip file
+        :param directory: The directory to extract the files to
+        :raises ValueError: If a file would be extracted outside of the directory (nothing is extracted then)
+        """
+        fs, path = fsspec.core.url_to_fs(directory)
+        with fsspec.open(zip_file, 'rb') as zf, zipfile.ZipFile(zf) as zipf:
+            if zipf.comment == DEDUPE_COMMENT:
+                entries = {file: f'{OBJECTS_DIR}/{_hash}' for file, _hash in load_json(zipf.read(PATHS_NAME)).items()}
+            else:
+                entries = {
+                    name: name for name in sorted(zipf.namelist()) if name != DIFF_NAME and not name.endswith('/')
+                }
+            targets = {file: Manifest._extract_target(path, file) for file in entries}
+            for parent in {fs._parent(target) for target in targets.values()}:
+                fs.mkdirs(parent, exist_ok=True)
+            if len(entries) < 2:
+                # Not worth starting a thread pool for a single file
+                for file, name in entries.items():
+                    Manifest._extract_member(zipf, name, fs, targets[file])
+                return
+            # ZipFile reads are serialized on a lock but decompression and the writes are not, overlap them
+            with ThreadPoolExecutor(max_workers=min(settings.SYNC_WORKERS, len(entries))) as executor:
+                futures = [
+                    executor.submit(Manifest._extract_member, zipf, name, fs, targets[file])
+                    for file, name in entries.items()
+                ]
+                for future in futures:
+                    future.result()
+
+    @staticmethod
+    def _extract_target(directory: str, file: str) -> str:
+        """
+        Get the path a file from a zip is extracted to.
+        Like zipfile's extract, paths that would end up outside of the directory (zip slip) are refused.
+        :param directory: The directory the files are extracted to
+        :param file: The relative file path from the zip
+        :return: The target file path
+        :raises ValueError: If the path is absolute, has a drive letter or a '..' component
+        """
+        normalized = file.replace('\\', '/')
+        if normalized.startswith('/') or ntpath.splitdrive(normalized)[0] or '..' in normalized.split('/'):
+            raise ValueError(f'Refusing to extract {file} outside of {directory}')
+        root = posixpath.normpath(directory)
+        prefix = root if root.endswith('/') else f'{root}/'
+        target = posixpath.normpath(f'{prefix}{normalized}')
+        if not target.startswith(prefix):
+            raise ValueError(f'Refusing to extract {file} outside of {directory}')
+        return target
+
+    @staticmethod
+    def _extract_member(zipf: zipfile.ZipFile, name: str, fs, target: str):
+        """
+        Extract a single zip member to a file
+        :param zipf: The open zip file
+        :param name: The name of the member in the zip
+        :param fs: The filesystem of the target
+        :param target: The target file path
+        """
+        with zipf.open(name) as src, fs.open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, settings.CHUNK_SIZE)
+
+    @staticmethod
+    def _directory_batches(entries: list):
+        """
+        Split (zip entry, file) pairs into batches of at most _CAT_BATCH files from the same directory
+        :param entries: The (zip entry, file) pairs in tree order
+        :return: Generator of lists of pairs
+        """
+        for _, group in groupby(entries, key=lambda entry: tree_order(entry[1])[0]):
+            group = list(group)
+            for start in range(0, len(group), _CAT_BATCH):
+                yield group[start:start + _CAT_BATCH]
+
+    def _is_small_remote(self, fs, file: str) -> bool:
+        """
+        Check if a file is small enough to be fetched in a batch (see settings.CAT_THRESHOLD)
+        :param fs: The filesystem of the file
+        :param file: The path of the file relative to the root
+        :return: True if the file is remote and its recorded size is at most the threshold
+        """
+        if not settings.CAT_THRESHOLD or isinstance(fs, LocalFileSystem):
+            # Local reads have no request overhead to save
+            return False
+        if not _GLOB_CHARS.isdisjoint(file):
+            # fs.cat expands glob characters (pages/[id].tsx), these files are streamed instead
+            return False
+        size = self.stats.get(file, {}).get('size')
+        return size is not None and size <= settings.CAT_THRESHOLD
+
+    @staticmethod
+    def remote_md5(info: dict) -> Optional[str]:
+        """
+        Get the MD5 checksum of a file reported by an object store, if it can be trusted.
+        Google Cloud Storage reports md5Hash for every (non composite) object. S3 ETags are only the MD5 of the
+        content for single part uploads without KMS/customer key encryption, so they are only used when
+        MANIFESTLY_TRUST_ETAG is enabled.
+        :param info: The fsspec info dictionary
+        :return: The hex MD5 checksum, or None
+        """
+        md5_hash = info.get('md5Hash')
+        if md5_hash:
+            return base64.b64decode(md5_hash).hex()
+        etag = info.get('ETag')
+        if settings.TRUST_ETAG and etag:
+            etag = etag.strip('"')
+            if len(etag) == 32 and '-' not in etag:
+                return etag.lower()
+        return None
+
+    @staticmethod
+    def open_sequential(fs, path: str):
+        """
+        Open a file that will be read from start to end (hashing or copying).
+        Remote files use a large read ahead block so that the whole file is fetched in a few requests.
+        :param fs: The filesystem
+        :param path: The file path
+        :return: The binary file object
+        """
+        if isinstance(fs, LocalFileSystem):
+            return fs.open(path, 'rb')
+        return fs.open(path, 'rb', block_size=settings.READ_BLOCK_SIZE, cache_type=settings.READ_CACHE_TYPE)
+
+    @classmethod
+    def copy_file(cls, fs_source, source_file: str, fs_target, target_file: str):
+        """
+        Copy a file between two filesystems without loading it into memory
+        :param fs_source: The source filesystem
+        :param source_file: The source file path
+        :param fs_target: The target filesystem
+        :param target_file: The target file path
+        """
+        source_local = isinstance(fs_source, LocalFileSystem)
+        target_local = isinstance(fs_target, LocalFileSystem)
+        if source_local and target_local:
+            # shutil.copyfile copies in the kernel where possible (sendfile/fcopyfile)
+            shutil.copyfile(source_file, target_file)
+        elif fs_source is fs_target:
+            # Let the store copy the object server side (e.g. S3 CopyObject)
+            fs_source.cp_file(source_file, target_file)
+        elif source_local:
+            fs_target.put_file(source_file, target_file)
+        elif target_local:
+            fs_source.get_file(source_file, target_file)
+        else:
+            cls._stream_copy(fs_source, source_file, fs_target, target_file)
+
+    @classmethod
+    def _stream_copy(cls, fs_source, source_file: str, fs_target, target_file: str):
+        """
+        Stream a file between two remote filesystems one chunk at a time
+        :param fs_source: The source filesystem
+        :param source_file: The source file path
+        :param fs_target: The target filesystem
+        :param target_file: The target file path
+        """
+        with cls.open_sequential(fs_source, source_file) as src, fs_target.open(target_file, 'wb') as tgt:
+            shutil.copyfileobj(src, tgt, settings.CHUNK_SIZE)
+
+    @classmethod
+    def _copy_files(cls, fs_source, fs_target, copies: list):
+        """
+        Copy files in parallel.
+        All copies are attempted, failures are reported and the first one is raised once they finish.
+        :param fs_source: The source filesystem
+        :param fs_target: The target filesystem
+        :param copies: List of (source file, target file) tuples
+        """
+        if not copies:
+            return
+        if len(copies) == 1:
+            # Not worth starting a thread pool for a single copy
+            (source_file, target_file), = copies
+            cls.copy_file(fs_source, source_file, fs_target, target_file)
+            return
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(settings.SYNC_WORKERS, len(copies))) as executor:
+            futures = {
+                executor.submit(cls.copy_file, fs_source, source_file, fs_target, target_file): source_file
+                for source_file, target_file in copies
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Failed to copy {futures[future]}: {e}')
+                    errors.append(e)
+        if errors:
+            raise errors[0]
+
+    @classmethod
+    def hash_files(cls, fs, files: dict, algorithm=settings.DEFAULT_HASH_ALGORITHM, infos: dict = None,
+                   known: dict = None, workers: int = None) -> dict:
+        """
+        Calculate the hashes of many files in parallel.
+        Hashing releases the GIL, so threads overlap both the disk/network reads and the hashing itself.
+        :param fs: The filesystem the files are on
+        :param files: Dictionary of manifest (relative) paths to full file paths
+        :param algorithm: The hash algorithm to use
+        :param infos: Optional dictionary of manifest paths to fsspec info. For md5, checksums reported by the object
+            store are used instead of reading the files.
+        :param known: Optional dictionary of manifest paths to hashes that are already known (these files are not read)
+        :param workers: Number of threads (defaults to settings.HASH_WORKERS, 0 means twice the number of CPUs)
+        :return: Dictionary of manifest paths to hashes, in the same order as files
+        """
+        known = dict(known) if known else {}
+        if infos and algorithm == 'md5':
+            for name in files:
+                _md5 = cls.remote_md5(infos[name]) if name in infos and name not in known else None
+                if _md5:
+                    known[name] = _md5
+        if known:
+            hashed = cls.hash_files(fs, {n: p for n, p in files.items() if n not in known}, algorithm, infos=infos,
+                                    workers=workers)
+            return {name: known[name] if name in known else hashed[name] for name in files}
+        if workers is None:
+            workers = settings.HASH_WORKERS
+        workers = min(workers or (os.cpu_count() or 1) * 2, len(files))
+        if workers <= 1:
+            # Not worth starting a thread pool
+            return {name: cls._hash_path(fs, file_path, algorithm) for name, file_path in files.items()}
+        # Files that fit in a single chunk are hashed in batches to spread the thread pool overhead of each task
+        small = [name for name in files if infos and (infos.get(name) or {}).get('size') is not None
+                 and infos[name]['size'] <= settings.CHUNK_SIZE]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for start in range(0, len(small), _HASH_BATCH):
+                batch = small[start:start + _HASH_BATCH]
+                future = executor.submit(cls._hash_small_files, fs, [files[name] for name in batch], algorithm)
+                for index, name in enumerate(batch):
+                    futures[name] = (future, index)
+            for name, file_path in files.items():
+                if name not in futures:
+                    futures[name] = (executor.submit(cls._hash_path, fs, file_path, algorithm), None)
+            hashes = {}
+            for name in files:
+                future, index = futures[name]
+                hashes[name] = future.result() if index is None else future.result()[index]
+            return hashes
+
+    @classmethod
+    def _hash_small_files(cls, fs, paths: list, algorithm=settings.DEFAULT_HASH_ALGORITHM) -> list:
+        """
+        Calculate the hashes of small files, reading each file with a single call
+        :param fs: The filesystem
+        :param paths: The file paths
+        :param algorithm: The hash algorithm to use
+        :return: List of hashes in the same order as paths
+        """
+        if isinstance(fs, LocalFileSystem):
+            return [cls._hash_local_path(path, algorithm) for path in paths]
+        hashes = []
+        for path in paths:
+            hasher = new_hasher(algorithm)
+            hasher.update(fs.cat_file(path))
+            hashes.append(hasher.hexdigest())
+        return hashes
+
+    @classmethod
+    def calculate_hash(cls, file: OpenFile, algorithm=settings.DEFAULT_HASH_ALGORITHM):
         """
         Calculate the hash of a file
         :param file: The OpenFile object
         :param algorithm: The hash algorithm to use
         :return: The hash of the file
         """
-        hasher = hashlib.new(algorithm)
+        if isinstance(file, OpenFile) and 'b' not in file.mode:
+            # Hashing must always operate on the raw bytes
+            file = file.fs.open(file.path, 'rb')
         with file as f:
+            return cls._hash_fileobj(f, algorithm)
+
+    @classmethod
+    def _hash_path(cls, fs, path: str, algorithm=settings.DEFAULT_HASH_ALGORITHM):
+        """
+        Calculate the hash of a file from its path, without an OpenFile wrapper
+        :param fs: The filesystem
+        :param path: The file path
+        :param algorithm: The hash algorithm to use
+        :return: The hash of the file
+        """
+        if algorithm == 'blake3' and isinstance(fs, LocalFileSystem):
+            # blake3 memory maps the file itself and hashes it in parallel
+            hasher = new_hasher(algorithm)
+            hasher.update_mmap(path)
+            return hasher.hexdigest()
+        if isinstance(fs, LocalFileSystem):
+            return cls._hash_local_path(path, algorithm)
+        with cls.open_sequential(fs, path) as f:
+            return cls._hash_fileobj(f, algorithm)
+
+    @classmethod
+    def _hash_local_path(cls, path: str, algorithm=settings.DEFAULT_HASH_ALGORITHM):
+        """
+        Calculate the hash of a local file with a plain unbuffered file (no fsspec file wrapper).
+        This keeps the per file overhead low when hashing many small files.
+        :param path: The local file path
+        :param algorithm: The hash algorithm to use
+        :return: The hash of the file
+        """
+        with open(path, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = cls._hash_mmap(f.fileno(), size, algorithm)
+            if digest is not None:
+                return digest
+            if size > settings.CHUNK_SIZE:
+                return cls._hash_fileobj(f, algorithm)
+            # Small files are read with a single call
+            hasher = new_hasher(algorithm)
+            hasher.update(f.read())
+            return hasher.hexdigest()
+
+    @staticmethod
+    def _hash_mmap(fileno: int, size: int, algorithm=settings.DEFAULT_HASH_ALGORITHM) -> Optional[str]:
+        """
+        Calculate the hash of a large local file straight from the page cache without copying.
+        blake3 hashes the mapping with multiple threads (see new_hasher).
+        :param fileno: The file descriptor of the open file
+        :param size: The size of the file
+        :param algorithm: The hash algorithm to use
+        :return: The hash of the file, or None if the file is smaller than settings.MMAP_THRESHOLD (or mmap is off)
+        """
+        if not settings.MMAP_THRESHOLD or size < settings.MMAP_THRESHOLD:
+            return None
+        hasher = new_hasher(algorithm)
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mm:
+            hasher.update(mm)
+        return hasher.hexdigest()
+
+    @classmethod
+    def _hash_fileobj(cls, f, algorithm=settings.DEFAULT_HASH_ALGORITHM):
+        """
+        Calculate the hash of an open binary file object
+        :param f: The file object
+        :param algorithm: The hash algorithm to use
+        :return: The hash of the file
+        """
+        if settings.MMAP_THRESHOLD and isinstance(getattr(f, 'fs', None), LocalFileSystem):
+            fileno = f.fileno()
+            digest = cls._hash_mmap(fileno, os.fstat(fileno).st_size, algorithm)
+            if digest is not None:
+                return digest
+        if not hasattr(f, 'readinto'):
+            # Not every file-like object supports reading into a buffer
+            hasher = new_hasher(algorithm)
             while chunk := f.read(settings.CHUNK_SIZE):
                 hasher.update(chunk)
+            return hasher.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+ runs the read/update loop in C
+            return hashlib.file_digest(f, lambda: new_hasher(algorithm)).hexdigest()
+        # Reuse a single buffer instead of allocating a bytes object per chunk
+        hasher = new_hasher(algorithm)
+        buf = bytearray(settings.CHUNK_SIZE)
+        view = memoryview(buf)
+        while size := f.readinto(buf):
+            hasher.update(view[:size])
         return hasher.hexdigest()
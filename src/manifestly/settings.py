@@ -3,7 +3,30 @@ Manifestly resolved settings from environment variables
 """
 import os
 
+
+def _getenv_bool(name, default=None):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 DEFAULT_HASH_ALGORITHM = os.getenv('MANIFESTLY_HASH_ALGORITHM', 'sha256')
 MANIFEST_NAME = os.getenv('MANIFESTLY_NAME', '.manifestly.json')
 MANIFESTLY_IGNORE = os.getenv('MANIFESTLY_IGNORE', '.manifestlyignore')
-CHUNK_SIZE = int(os.getenv('MANIFESTLY_CHUNK_SIZE', 8192))
+CHUNK_SIZE = int(os.getenv('MANIFESTLY_CHUNK_SIZE', 1024 * 1024))
+# Local files of at least this many bytes are memory mapped for hashing, 0 disables memory mapping
+MMAP_THRESHOLD = int(os.getenv('MANIFESTLY_MMAP_THRESHOLD', 1024 * 1024))
+# Read ahead block size and fsspec cache type used to read remote files sequentially (hashing, copying)
+READ_BLOCK_SIZE = int(os.getenv('MANIFESTLY_READ_BLOCK_SIZE', 4 * 1024 * 1024))
+READ_CACHE_TYPE = os.getenv('MANIFESTLY_READ_CACHE_TYPE', 'readahead')
+# Remote files up to this many bytes are fetched in batches (fs.cat) when building patch zips, 0 disables batching
+CAT_THRESHOLD = int(os.getenv('MANIFESTLY_CAT_THRESHOLD', 1024 * 1024))
+# Number of threads used to hash files, 0 means twice the number of CPUs
+HASH_WORKERS = int(os.getenv('MANIFESTLY_HASH_WORKERS', 0))
+# Number of threads used to copy files in sync and to extract files in punzip
+SYNC_WORKERS = int(os.getenv('MANIFESTLY_SYNC_WORKERS', 16))
+# Use S3 ETags as MD5 checksums (only valid for single part uploads without KMS/customer key encryption)
+TRUST_ETAG = _getenv_bool('MANIFESTLY_TRUST_ETAG', False)
+# None means auto-detect on import (see manifestly.accel)
+USE_SHA_ACCELERATED = _getenv_bool('MANIFESTLY_USE_SHA_ACCELERATED')
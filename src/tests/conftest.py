@@ -0,0 +1,14 @@
+"""
+Run the fast tests first so failures surface before the slow tests finish
+"""
+import pytest
+
+
+def pytest_collection_modifyitems(items):
+    """
+    Mark every test that is not marked slow as fast and move the slow tests to the end (the order is otherwise kept)
+    """
+    for item in items:
+        if item.get_closest_marker('slow') is None:
+            item.add_marker(pytest.mark.fast)
+    items.sort(key=lambda item: item.get_closest_marker('slow') is not None)
@@ -0,0 +1,79 @@
+"""
+Shared helpers for the tests
+"""
+import os
+import pathlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
+
+from manifestly import Manifest
+
+# This has the test files, do not create manifests in this as it is checked into git
+TEST_FILES = pathlib.Path(__file__).parent / 'test_files'
+# Below this many files a thread pool costs more than it saves (except on Windows)
+PARALLEL_COPY_FILES = 64
+
+
+@lru_cache(maxsize=None)
+def snapshot(directory=TEST_FILES) -> tuple:
+    """
+    Read a directory tree into memory once per test process.
+    The fixture tree is small and read only, so later copies only need to write the files.
+    :param directory: The directory to snapshot
+    :return: Tuple of (relative directories, ((relative file, content), ...))
+    """
+    directories = []
+    files = []
+    _scan(os.fspath(directory), pathlib.PurePath(), directories, files)
+    return tuple(directories), tuple(files)
+
+
+def _scan(path: str, relative: pathlib.PurePath, directories: list, files: list):
+    """
+    Walk a directory with os.scandir, the entry types come from the directory listing without another stat
+    :param path: The directory path
+    :param relative: The directory path relative to the snapshot root
+    :param directories: List the relative directories are added to (parents first)
+    :param files: List the (relative file, content) pairs are added to
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(relative / entry.name)
+                _scan(entry.path, relative / entry.name, directories, files)
+            else:
+                with open(entry.path, 'rb') as f:
+                    files.append((relative / entry.name, f.read()))
+
+
+@lru_cache(maxsize=None)
+def pristine_manifest() -> MappingProxyType:
+    """
+    The manifest of the unmodified test files, hashed once per test process
+    :return: Read only mapping of relative paths to hashes
+    """
+    return MappingProxyType(Manifest.generate(TEST_FILES).manifest)
+
+
+def copy_test_files(dest, directory=TEST_FILES):
+    """
+    Copy the test files into a directory.
+    The files are regular copies (not hardlinks), so tests can safely modify them in place.
+    :param dest: The destination directory
+    :param directory: The directory to copy (defaults to the test files)
+    """
+    dest = pathlib.Path(dest)
+    directories, files = snapshot(directory)
+    # Create the directories up front so the writes never race on them
+    dest.mkdir(parents=True, exist_ok=True)
+    for d in directories:
+        (dest / d).mkdir(exist_ok=True)
+    if sys.platform == 'win32' or len(files) >= PARALLEL_COPY_FILES:
+        # Per file syscall latency dominates small copies (especially on Windows), overlap the writes
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            list(executor.map(lambda file: (dest / file[0]).write_bytes(file[1]), files))
+    else:
+        for relative_path, content in files:
+            (dest / relative_path).write_bytes(content)
@@ -1,42 +1,68 @@
-import pathlib
-import shutil
-import tempfile
+import contextlib
+import io
 import unittest
+import zipfile
 
+import pytest
 from click.testing import CliRunner
 
 from manifestly import settings
-from manifestly.cli import cli
+from manifestly.cli import changed_cmd, cli, generate_cmd, refresh_cmd
 
+from .helpers import TEST_FILES, copy_test_files
 
+
+def call_command(command, *args) -> str:
+    """
+    Call a command without the CliRunner isolation (argument parsing is covered by the CliRunner tests)
+    :param command: The click command
+    :param args: The arguments for the command function
+    :return: The output of the command
+    """
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        command.callback(*args)
+    return output.getvalue()
+
+
+@pytest.fixture(scope='class')
+def prebuilt(request, tmp_path_factory):
+    """
+    Generate the manifest of the test files once per test class, every test starts from a copy of this directory
+    """
+    request.cls._prebuilt_dir = tmp_path_factory.mktemp('prebuilt')
+    copy_test_files(request.cls._prebuilt_dir)
+    call_command(generate_cmd, str(request.cls._prebuilt_dir), settings.DEFAULT_HASH_ALGORITHM, None)
+
+
+@pytest.mark.usefixtures('prebuilt')
 class ManifestlyCLITestCase(unittest.TestCase):
 
+    @pytest.fixture(autouse=True)
+    def _tmp_dirs(self, tmp_path):
+        # pytest removes old temporary directories in later sessions, not in every tearDown
+        self._tmp_path = tmp_path
+        self._tmpdir = tmp_path / 'tmp'
+
     def setUp(self):
         self.runner = CliRunner()
-        self._tmpdir = pathlib.Path(tempfile.mkdtemp())
-        self.manifest_dir = pathlib.Path(__file__).parent / 'test_files'
+        self.manifest_dir = TEST_FILES
         self.copy_test_files(self._tmpdir)
 
-    def tearDown(self):
-        shutil.rmtree(str(self._tmpdir))
-
     def copy_test_files(self, dest):
         """
-        Copy over files from the source to the destination
+        Copy over the test files and their generated manifest to the destination
         """
-        for f in self.manifest_dir.iterdir():
-            if f.is_dir():
-                shutil.copytree(str(f), str(dest / f.name))
-            else:
-                shutil.copy(str(f), str(dest))
+        copy_test_files(dest, self._prebuilt_dir)
 
     def test_generate_cmd(self):
+        (self._tmpdir / settings.MANIFEST_NAME).unlink()
         result = self.runner.invoke(cli, ['generate', str(self._tmpdir)])
         self.assertEqual(result.exit_code, 0)
         manifest_file = self._tmpdir / settings.MANIFEST_NAME
         self.assertTrue(manifest_file.exists())
 
     def test_generate_cmd2(self):
+        (self._tmpdir / settings.MANIFEST_NAME).unlink()
         manifest_file = str(self._tmpdir / settings.MANIFEST_NAME)
         result = self.runner.invoke(cli, ['generate', str(self._tmpdir), '--output-file', manifest_file])
         self.assertEqual(result.exit_code, 0)
@@ -44,10 +70,7 @@ class ManifestlyCLITestCase(unittest.TestCase):
         self.assertTrue(manifest_file.exists())
 
     def test_changed_cmd(self):
-        # First, generate a manifest
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
-
-        # Now, change a file
+        # Add a file after the manifest was generated
         (self._tmpdir / 'new_file.txt').write_text('new content')
 
         result = self.runner.invoke(cli, ['changed', str(self._tmpdir / settings.MANIFEST_NAME)])
@@ -55,28 +78,29 @@ class ManifestlyCLITestCase(unittest.TestCase):
         self.assertIn('Changed files:', result.output)
 
     def test_changed_cmd_no_changes(self):
-        # First, generate a manifest
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
+        output = call_command(changed_cmd, str(self._tmpdir / settings.MANIFEST_NAME), None)
+        self.assertIn('No files have changed', output)
+        self.assertNotIn('Changed files:', output)
 
-        result = self.runner.invoke(cli, ['changed', str(self._tmpdir / settings.MANIFEST_NAME)])
+        result = self.runner.invoke(cli, ['changed', str(self._tmpdir / settings.MANIFEST_NAME), '--verify'])
         self.assertEqual(result.exit_code, 0)
         self.assertIn('No files have changed', result.output)
-        self.assertNotIn('Changed files:', result.output)
 
     def test_refresh_cmd(self):
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
         manifest_file = self._tmpdir / settings.MANIFEST_NAME
         self.assertTrue(manifest_file.exists())
 
-        result = self.runner.invoke(cli, ['refresh', str(manifest_file)])
+        self.assertIn('Manifest refreshed', call_command(refresh_cmd, str(manifest_file)))
+
+        result = self.runner.invoke(cli, ['refresh', str(manifest_file), '--verify'])
         self.assertEqual(result.exit_code, 0)
         self.assertIn('Manifest refreshed', result.output)
 
     def test_sync_cmd(self):
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
         manifest_file = self._tmpdir / settings.MANIFEST_NAME
 
-        sync_dir = pathlib.Path(tempfile.mkdtemp())
+        sync_dir = self._tmp_path / 'sync'
+        sync_dir.mkdir()
         sync_manifest_file = sync_dir / 'sync_manifest.json'
 
         result = self.runner.invoke(cli, [
@@ -85,13 +109,13 @@ class ManifestlyCLITestCase(unittest.TestCase):
         ])
         self.assertEqual(result.exit_code, 0)
         self.assertIn('Dry run completed', result.output)
-        shutil.rmtree(str(sync_dir))
 
+    @pytest.mark.slow
     def test_sync_cmd_refresh(self):
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
         manifest_file = self._tmpdir / settings.MANIFEST_NAME
 
-        sync_dir = pathlib.Path(tempfile.mkdtemp())
+        sync_dir = self._tmp_path / 'sync'
+        sync_dir.mkdir()
         sync_manifest_file = sync_dir / 'sync_manifest.json'
 
         result = self.runner.invoke(cli, [
@@ -99,30 +123,26 @@ class ManifestlyCLITestCase(unittest.TestCase):
             '--source_directory', str(self._tmpdir), '--target_directory', str(sync_dir), '--refresh'])
         self.assertEqual(result.exit_code, 0)
         self.assertIn('Synced', result.output)
-        shutil.rmtree(str(sync_dir))
 
     def test_compare_cmd(self):
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
         manifest_file = self._tmpdir / settings.MANIFEST_NAME
 
-        compare_dir = pathlib.Path(tempfile.mkdtemp())
+        compare_dir = self._tmp_path / 'compare'
+        compare_dir.mkdir()
         self.copy_test_files(compare_dir)
         compare_manifest_file = compare_dir / 'compare_manifest.json'
-        self.runner.invoke(cli, ['generate', str(compare_dir)])
 
         result = self.runner.invoke(cli, ['compare', str(manifest_file), str(compare_manifest_file)])
         self.assertEqual(result.exit_code, 0)
         self.assertIn('added', result.output)
-        shutil.rmtree(str(compare_dir))
 
     def test_patch_cmd(self):
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
         manifest_file = self._tmpdir / settings.MANIFEST_NAME
 
-        patch_dir = pathlib.Path(tempfile.mkdtemp())
+        patch_dir = self._tmp_path / 'patch'
+        patch_dir.mkdir()
         self.copy_test_files(patch_dir)
         patch_manifest_file = patch_dir / 'patch_manifest.json'
-        self.runner.invoke(cli, ['generate', str(patch_dir)])
 
         output_patch_file = self._tmpdir / 'output_patch.json'
 
@@ -132,16 +152,15 @@ class ManifestlyCLITestCase(unittest.TestCase):
         self.assertEqual(result.exit_code, 0)
         self.assertIn('Patch saved', result.output)
         self.assertTrue(output_patch_file.exists())
-        shutil.rmtree(str(patch_dir))
 
+    @pytest.mark.slow
     def test_pzip_cmd(self):
-        self.runner.invoke(cli, ['generate', str(self._tmpdir)])
         manifest_file = self._tmpdir / settings.MANIFEST_NAME
 
-        pzip_dir = pathlib.Path(tempfile.mkdtemp())
+        pzip_dir = self._tmp_path / 'pzip'
+        pzip_dir.mkdir()
         self.copy_test_files(pzip_dir)
         pzip_manifest_file = pzip_dir / 'pzip_manifest.json'
-        self.runner.invoke(cli, ['generate', str(pzip_dir)])
 
         output_zip_file = self._tmpdir / 'output.zip'
 
@@ -151,8 +170,20 @@ class ManifestlyCLITestCase(unittest.TestCase):
         self.assertEqual(result.exit_code, 0)
         self.assertIn('Zip file saved', result.output)
         self.assertTrue(output_zip_file.exists())
-        shutil.rmtree(str(pzip_dir))
 
+        result = self.runner.invoke(cli, [
+            'pzip', str(manifest_file), str(pzip_manifest_file), str(output_zip_file), '--store'
+        ])
+        self.assertEqual(result.exit_code, 0)
+        with zipfile.ZipFile(str(output_zip_file)) as z:
+            self.assertEqual({i.compress_type for i in z.infolist()}, {zipfile.ZIP_STORED})
 
-if __name__ == '__main__':
-    unittest.main()  # pragma: no cover
+        result = self.runner.invoke(cli, [
+            'pzip', str(manifest_file), str(pzip_manifest_file), str(output_zip_file), '--dedupe'
+        ])
+        self.assertEqual(result.exit_code, 0)
+        extract_dir = pzip_dir / 'extracted'
+        result = self.runner.invoke(cli, ['punzip', str(output_zip_file), str(extract_dir)])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Files extracted', result.output)
+        self.assertEqual((extract_dir / 'test_css.css').read_bytes(), (self._tmpdir / 'test_css.css').read_bytes())
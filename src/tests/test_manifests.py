@@ -1,14 +1,21 @@
 import json
+import os
 import pathlib
-import shutil
-import tempfile
+import pickle
+import time
 import unittest
+import zipfile
+from unittest import mock
 
 import fsspec
+import pytest
 
-from manifestly import Manifest, settings
+from manifestly import Manifest, core, settings
 from manifestly.core import ManifestlyIgnore
 
+from . import helpers
+from .helpers import TEST_FILES, copy_test_files, pristine_manifest, snapshot
+
 NO_CHANGES = {'added': {}, 'removed': {}, 'changed': {}}
 
 
@@ -18,68 +25,98 @@ class ManifestlyGeneralTestCase(unittest.TestCase):
         import manifestly
         self.assertEqual(manifestly.get_version(), manifestly.__version__)
 
+    def test_sha_accelerated(self):
+        from manifestly import accel
+        self.assertIsInstance(settings.USE_SHA_ACCELERATED, bool)
+        self.assertIsInstance(accel.sha_accelerated(), bool)
+        self.assertGreater(accel.hash_throughput(size=1024, rounds=1), 0)
+        # Warn when SHA-256 runs at software speed on a CPU with SHA extensions
+        with mock.patch.object(accel, 'cpu_has_sha_extensions', return_value=True), \
+                mock.patch.object(accel, 'hash_throughput', return_value=200):
+            self.assertIn('200 MiB/s', accel.software_sha_warning())
+        with mock.patch.object(accel, 'cpu_has_sha_extensions', return_value=True), \
+                mock.patch.object(accel, 'hash_throughput', return_value=1000):
+            self.assertIsNone(accel.software_sha_warning())
+        with mock.patch.object(accel, 'cpu_has_sha_extensions', return_value=False):
+            self.assertIsNone(accel.software_sha_warning())
+
 
 class ManifestlyManifestTestCase(unittest.TestCase):
 
+    @pytest.fixture(autouse=True)
+    def _tmp_dirs(self, tmp_path):
+        # pytest removes old temporary directories in later sessions, not in every tearDown
+        self._tmpdir = tmp_path / 'tmp'
+        self._syncdir = tmp_path / 'sync'
+        self._tmpdir.mkdir()
+        self._syncdir.mkdir()
+
     def setUp(self):
         """
         Common setup for all tests
         """
-
-        self._tmpdir = pathlib.Path(tempfile.mkdtemp())
-        self._syncdir = pathlib.Path(tempfile.mkdtemp())
-
         # This has the test files, do not create manifests in this as it is checked into git
         # Copy files into the tmpdir
-        self.manifest_dir = pathlib.Path(__file__).parent / 'test_files'
+        self.manifest_dir = TEST_FILES
 
     def copy_test_files(self, dest):
         """
         Copy over files from the source to the destination
         """
-        # Make sure the destination exists
-        dest = pathlib.Path(dest)
-        dest.mkdir(parents=True, exist_ok=True)
-        for f in self.manifest_dir.iterdir():
-            if f.is_dir():
-                shutil.copytree(str(f), str(dest / f.name))
-            else:
-                shutil.copy(str(f), str(dest))
-
-    def tearDown(self):
+        copy_test_files(dest, self.manifest_dir)
+
+    def memory_dir(self) -> tuple:
         """
-        Common teardown for all tests
+        Create a directory on the (process wide) memory filesystem that is unique to the test.
+        It is removed when the test finishes, even if the test fails.
+        :return: Tuple of (memory filesystem, directory path)
         """
-        shutil.rmtree(str(self._tmpdir))
-        shutil.rmtree(str(self._syncdir))
+        memory = fsspec.filesystem('memory')
+        path = f'/{self.id()}'
+        memory.makedirs(path, exist_ok=True)
+        self.addCleanup(memory.rm, path, recursive=True)
+        return memory, path
+
+    def test_copy_test_files(self):
+        # Serial and parallel copies produce the same tree
+        expected = Manifest.generate(self.manifest_dir).manifest
+        for parallel_files in (len(snapshot()[1]) + 1, 1):
+            dest = self._tmpdir / str(parallel_files)
+            with mock.patch.object(helpers, 'PARALLEL_COPY_FILES', parallel_files):
+                copy_test_files(dest)
+            self.assertEqual(Manifest.generate(dest).manifest, expected)
 
     def test_manifest_creation(self):
         manifest_dir = pathlib.Path(__file__).parent / 'test_files'
         _manifest_file = self._tmpdir / '.manifest.json'
-        m = Manifest(str(_manifest_file), root=str(manifest_dir))
+        m = Manifest(_manifest_file, root=manifest_dir)
         m.refresh()
         self.assertTrue(_manifest_file.exists())
         self.assertTrue(m.manifest)
-        print(m.manifest)
+
+        # The root filesystem is resolved once per root
+        self.assertIs(m.root_fs, m.root_fs)
+        self.assertEqual(m.root_fs[1], str(manifest_dir))
+        m.root = str(self._tmpdir)
+        self.assertEqual(m.root_fs[1], str(self._tmpdir))
 
     def test_manifest_sync(self):
         _sync_manifest = self._syncdir / '.manifestly.json'
 
         _manifest_file = self._tmpdir / '.manifest.json'
-        m = Manifest(str(_manifest_file), root=str(self.manifest_dir))
+        m = Manifest(_manifest_file, root=self.manifest_dir)
         m.refresh()
         self.assertTrue(_manifest_file.exists())
 
         self.assertFalse(_sync_manifest.exists())
-        m.sync(Manifest(str(_sync_manifest), root=str(self._syncdir)), dry_run=True)
+        m.sync(Manifest(_sync_manifest, root=self._syncdir), dry_run=True)
         self.assertTrue(_sync_manifest.exists())
         self.assertEqual(_sync_manifest.read_text(), '{}')
-        m.sync(Manifest(str(_sync_manifest), root=str(self._syncdir)))
+        m.sync(Manifest(_sync_manifest, root=self._syncdir))
         self.assertTrue(_sync_manifest.exists())
-        print(m.manifest)
 
         # Load from directory
-        m2 = Manifest(str(self._syncdir))
+        m2 = Manifest(self._syncdir)
         self.assertTrue(m2.manifest)
 
     def test_resolve_root(self):
@@ -89,27 +126,32 @@ class ManifestlyManifestTestCase(unittest.TestCase):
         self.copy_test_files(self._tmpdir)
         self.copy_test_files(self._syncdir)
 
-        m = Manifest(str(_manifest_file), root=str(self.manifest_dir))
-        m.sync(Manifest(str(_sync_manifest), root=str(self._syncdir)))
+        m = Manifest(_manifest_file, root=self.manifest_dir)
+        m.sync(Manifest(_sync_manifest, root=self._syncdir))
         self.assertTrue(_sync_manifest.exists())
 
         # Resolve root from valid manifest file
-        m2 = Manifest(str(_manifest_file))
+        m2 = Manifest(_manifest_file)
         m2.refresh()
         self.assertTrue(m2.manifest)
         self.assertTrue(m2.root, str(self._tmpdir))
 
+        # changed resolves a missing root the same way
+        m2.root = None
+        self.assertEqual(m2.changed(), NO_CHANGES)
+        self.assertEqual(m2.root, str(self._tmpdir))
+
     def test_generation(self):
         _copy_dir = self._tmpdir / 'test_files'
         self.copy_test_files(_copy_dir)
 
-        m = Manifest.generate(str(_copy_dir), str(_copy_dir / settings.MANIFEST_NAME))
+        m = Manifest.generate(_copy_dir, _copy_dir / settings.MANIFEST_NAME)
         m.refresh()
         self.assertTrue(m.manifest)
 
-        # Generate based of the original files
-        m2 = Manifest(str(self._tmpdir / '.manifestly.json'), root=str(self.manifest_dir))
-        m2.refresh()
+        # The manifest of the original files (hashed once for all tests)
+        m2 = Manifest(self._tmpdir / '.manifestly.json', manifest=dict(pristine_manifest()),
+                      root=self.manifest_dir)
         self.assertTrue(m2.manifest)
 
         self.assertEqual(m2.changed(), NO_CHANGES)
@@ -126,28 +168,34 @@ class ManifestlyManifestTestCase(unittest.TestCase):
         self.assertTrue('.manifestlyignore' in m)
         self.assertNotEqual(m, 'test')
         self.assertTrue('.manifestlyignore' in m.keys())
-        self.assertTrue('0cc6c7041e35947e9cb27e32f237ed4db36745ea362000ad4d377e2653a63775' in m.values())
+        self.assertIn('0cc6c7041e35947e9cb27e32f237ed4db36745ea362000ad4d377e2653a63775', set(m.values()))
 
+    @pytest.mark.slow
     def test_changes(self):
         _orig_dir = self._tmpdir / 'orig_files'
         _change_dir = self._tmpdir / 'change_files'
         self.copy_test_files(_orig_dir)
         self.copy_test_files(_change_dir)
 
-        orig_manifest = Manifest.generate(str(_orig_dir), str(_orig_dir / settings.MANIFEST_NAME))
-        self.assertTrue(orig_manifest.manifest)
+        orig_manifest = Manifest.generate(_orig_dir, _orig_dir / settings.MANIFEST_NAME)
+        self.assertEqual(orig_manifest.manifest, pristine_manifest())
         orig_manifest.save()
-        _manifest_file = orig_manifest._reopen()
-        self.assertEqual(orig_manifest.manifest, json.loads(_manifest_file.open().read()))
+        with orig_manifest._reopen('rb') as fp:
+            self.assertEqual(Manifest._serialize(orig_manifest.manifest, orig_manifest.stats), json.load(fp))
         _old_manifest = orig_manifest.manifest
         orig_manifest.refresh()
         self.assertEqual(orig_manifest.manifest, _old_manifest)
 
-        change_manifest = Manifest.generate(str(_change_dir), str(_change_dir / settings.MANIFEST_NAME))
-        original_change_manifest = change_manifest.manifest.copy()
+        # The copy has the same content as the original files, so start from the cached manifest
+        change_manifest = Manifest(_change_dir / settings.MANIFEST_NAME, manifest=dict(pristine_manifest()),
+                                   root=_change_dir)
+        change_manifest.save()
+        # A pickled snapshot cannot be affected by anything the refresh does to the manifest
+        original_change_manifest = pickle.dumps(change_manifest.manifest, protocol=5)
+        # Refreshing without a root resolves it from the manifest file and rescans the directory
         change_manifest.root = None
         change_manifest.refresh()
-        self.assertEqual(change_manifest.manifest, original_change_manifest)
+        self.assertEqual(change_manifest.manifest, pickle.loads(original_change_manifest))
         change_manifest.save()
 
         # No changes
@@ -176,7 +224,7 @@ class ManifestlyManifestTestCase(unittest.TestCase):
 
         # Test the diff
         # Should be able to pass in the manifest object or the path to the manifest file/directory
-        diff = change_manifest.diff(str(_orig_dir))
+        diff = change_manifest.diff(_orig_dir)
         diff2 = change_manifest.diff(orig_manifest)
         self.assertEqual(diff, diff2)
 
@@ -187,7 +235,7 @@ class ManifestlyManifestTestCase(unittest.TestCase):
 
         # Create the patch
         patch_file = self._tmpdir / 'patch.json'
-        patch = change_manifest.patch(str(_orig_dir), str(patch_file))
+        patch = change_manifest.patch(_orig_dir, patch_file)
         self.assertTrue(patch)
         self.assertTrue(patch_file.exists())
 
@@ -195,22 +243,28 @@ class ManifestlyManifestTestCase(unittest.TestCase):
         zip_file = self._tmpdir / 'patch.zip'
         # Pass in the directory so we hit the case where we have a directory
         # You usually pass in the manifest object
-        change_manifest.pzip(str(_orig_dir), str(zip_file))
+        change_manifest.pzip(_orig_dir, zip_file)
         self.assertTrue(zip_file.exists())
         self.assertTrue(zip_file.stat().st_size > 0)
-        import zipfile
         extracted_dir = self._tmpdir / 'extracted'
         with zipfile.ZipFile(str(zip_file), 'r') as z:
-            z.extractall(str(extracted_dir))
+            self.assertEqual({i.compress_type for i in z.infolist()}, {zipfile.ZIP_DEFLATED})
+            diff = json.loads(z.read(core.DIFF_NAME))
+        # punzip extracts the members in parallel
+        Manifest.punzip(zip_file, extracted_dir)
         self.assertTrue((self._tmpdir / 'extracted').exists())
 
         # Check the files in the extracted zip
         self.assertTrue((extracted_dir / 'new_file.txt').exists())
         self.assertTrue((extracted_dir / 'subdirectory' / 'sub_ts.ts').exists())
         self.assertFalse((extracted_dir / 'test_css.css').exists())
+        self.assertFalse((extracted_dir / core.DIFF_NAME).exists())
+        self.assertEqual(diff, change_manifest.diff(_orig_dir))
+        self.assertIn('new_file.txt', diff['added'])
+        self.assertFalse(os.path.exists(core.DIFF_NAME))
 
         # Synchronize the changes to the original directory
-        change_manifest.sync(str(_orig_dir), dry_run=True)
+        change_manifest.sync(_orig_dir, dry_run=True)
 
         # Remove the added file and make sure it doesn't throw errors when we sync
         (_change_dir / 'new_file.txt').unlink()
@@ -219,7 +273,7 @@ class ManifestlyManifestTestCase(unittest.TestCase):
         self.assertFalse((_orig_dir / 'new_file.txt').exists())
 
         root = fsspec.open(str(change_manifest.root))
-        new_manifest = Manifest.generate(str(_change_dir),
+        new_manifest = Manifest.generate(_change_dir,
                                          str(_change_dir / settings.MANIFEST_NAME), root_path=root)
         new_manifest.save()
 
@@ -227,11 +281,283 @@ class ManifestlyManifestTestCase(unittest.TestCase):
         diff = new_manifest.diff(orig_manifest)
         self.assertEqual(diff, NO_CHANGES)
 
+    def test_changed_stats(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        # Stats of files modified in the last second are not trusted (see test_changed_racy)
+        _mtime = time.time() - 10
+        for _f in _orig_dir.rglob('*'):
+            os.utime(_f, (_mtime, _mtime))
+
+        m = Manifest.generate(_orig_dir, _orig_dir / settings.MANIFEST_NAME)
+        self.assertEqual(set(m.stats), set(m.manifest))
+
+        # Old manifests store bare hashes and are still loaded
+        _stored = json.loads((_orig_dir / settings.MANIFEST_NAME).read_text())
+        self.assertEqual(Manifest._deserialize(_stored), (m.manifest, m.stats))
+        self.assertEqual(Manifest._deserialize(m.manifest), (m.manifest, {}))
+
+        # Change the content but keep the size and modification time
+        _f = _orig_dir / 'test_css.css'
+        _stat = _f.stat()
+        _content = _f.read_bytes()
+        _f.write_bytes(bytes(reversed(_content)))
+        os.utime(str(_f), ns=(_stat.st_atime_ns, _stat.st_mtime_ns))
+
+        m2 = Manifest(_orig_dir)
+        self.assertEqual(m2.stats, m.stats)
+        self.assertEqual(m2.changed(), NO_CHANGES)
+        self.assertIn('test_css.css', m2.changed(verify=True)['changed'])
+
+        # refresh reuses the hash of files with unchanged stats
+        _old_hash = m2.manifest['test_css.css']
+        m2.refresh()
+        self.assertEqual(m2.manifest['test_css.css'], _old_hash)
+        m2.refresh(verify=True)
+        self.assertNotEqual(m2.manifest['test_css.css'], _old_hash)
+
+    def test_changed_racy(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        _f = _orig_dir / 'test_css.css'
+        _stat = _f.stat()
+
+        # The files were just written, a rewrite within the same mtime tick would keep their size and mtime
+        m = Manifest.generate(_orig_dir, _orig_dir / settings.MANIFEST_NAME)
+        self.assertNotIn('test_css.css', m.stats)
+        _f.write_bytes(bytes(reversed(_f.read_bytes())))
+        os.utime(str(_f), ns=(_stat.st_atime_ns, _stat.st_mtime_ns))
+        self.assertIn('test_css.css', m.changed()['changed'])
+
+        # Recorded stats are not trusted either while the mtime is racy
+        listed = time.time()
+        info = {'size': 10, 'mtime': listed - 0.5}
+        self.assertIsNone(Manifest.trusted_stat(info, listed))
+        info = {**info, 'mtime': listed - 5}
+        self.assertEqual(Manifest.trusted_stat(info, listed), info)
+        self.assertIsNone(Manifest.trusted_stat({'size': 10}, listed))
+
+    def test_reload(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        _manifest_file = _orig_dir / settings.MANIFEST_NAME
+        m = Manifest.generate(_orig_dir, _manifest_file)
+        # A manifest written in the last second is always read again (see test_reload_racy)
+        _mtime = time.time() - 10
+        os.utime(_manifest_file, (_mtime, _mtime))
+
+        m2 = Manifest(_orig_dir)
+        m2.load(force=False)
+        self.assertEqual(m2.manifest, m.manifest)
+        # The file has not changed since the last load, so the in memory manifest is kept
+        m2.manifest['unsaved.txt'] = 'hash'
+        m2.load(force=False)
+        self.assertIn('unsaved.txt', m2.manifest)
+        m2.load()
+        self.assertNotIn('unsaved.txt', m2.manifest)
+
+        # Reload when the file changed on disk
+        m2.load(force=False)
+        _hash = m.manifest.pop('test_css.css')
+        m.save()
+        self.assertEqual(m2.changed(reload=True)['added'], {'test_css.css': _hash})
+
+    def test_reload_racy(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        _manifest_file = _orig_dir / settings.MANIFEST_NAME
+        m = Manifest.generate(_orig_dir, _manifest_file)
+        m2 = Manifest(_orig_dir)
+        _stat = _manifest_file.stat()
+
+        # Rewrite the manifest with a hash of the same length within the same mtime tick
+        _hash = m.manifest['test_css.css']
+        m.manifest['test_css.css'] = _hash[::-1]
+        m.save()
+        os.utime(_manifest_file, ns=(_stat.st_atime_ns, _stat.st_mtime_ns))
+        self.assertEqual(_manifest_file.stat().st_size, _stat.st_size)
+        m2.load(force=False)
+        self.assertEqual(m2.manifest['test_css.css'], _hash[::-1])
+
+        # Object store checksums are trusted whatever the modification time
+        info = {'type': 'file', 'size': 10, 'mtime': time.time()}
+        self.assertIsNone(Manifest.manifest_fingerprint(info))
+        self.assertEqual(Manifest.manifest_fingerprint({**info, 'ETag': '"abc"'}), (10, info['mtime'], '"abc"'))
+        self.assertEqual(Manifest.manifest_fingerprint({**info, 'mtime': 0}), (10, 0, None))
+
+    def test_root_fs(self):
+        memory, remote = self.memory_dir()
+        m = Manifest(f'memory://{remote}/{settings.MANIFEST_NAME}')
+        # The root resolves to the filesystem of the manifest file
+        self.assertEqual(m.root, remote)
+        self.assertIs(m.root_fs[0], memory)
+        self.assertIs(m._reopen().fs, memory)
+
+    def test_pzip_remote(self):
+        memory, remote = self.memory_dir()
+        memory.pipe(f'{remote}/small.txt', b'small')
+        memory.pipe(f'{remote}/large.bin', b'0' * 64)
+        # A glob pattern that matches the other files of its directory
+        memory.pipe({f'{remote}/pages/[id].tsx': b'id', f'{remote}/pages/d.tsx': b'd', f'{remote}/pages/i.tsx': b'i'})
+        m = Manifest.generate(f'memory://{remote}')
+        m.root = f'memory://{remote}'
+        # The memory filesystem has no modification times, object stores report both
+        m.stats = {file: {'size': memory.size(f'{remote}/{file}'), 'mtime': 0} for file in m.manifest}
+        target = Manifest(self._tmpdir / settings.MANIFEST_NAME, manifest={}, root=self._tmpdir)
+        zip_file = self._tmpdir / 'patch.zip'
+        # Small files are fetched with a single batched request, large files are streamed
+        with mock.patch.object(settings, 'CAT_THRESHOLD', 16), \
+                mock.patch.object(memory, 'cat', wraps=memory.cat) as cat:
+            m.pzip(target, zip_file)
+        # Names with glob characters are streamed, fs.cat would expand them
+        self.assertEqual(cat.call_args_list, [mock.call([f'{remote}/small.txt']),
+                                              mock.call([f'{remote}/pages/d.tsx', f'{remote}/pages/i.tsx'])])
+        with zipfile.ZipFile(str(zip_file)) as z:
+            self.assertEqual(z.read('small.txt'), b'small')
+            self.assertEqual(z.read('pages/[id].tsx'), b'id')
+            self.assertEqual(z.read('pages/i.tsx'), b'i')
+            self.assertEqual(z.read('large.bin'), b'0' * 64)
+            self.assertEqual(json.loads(z.read(core.DIFF_NAME))['added'], m.manifest)
+
+    @pytest.mark.slow
+    def test_pzip_dedupe(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        for name in ('a.txt', 'b.txt', 'sub/c.txt'):
+            (_orig_dir / name).parent.mkdir(exist_ok=True)
+            (_orig_dir / name).write_text('duplicate')
+        # Files named like the entries of a deduplicated zip do not change how a plain zip is extracted
+        (_orig_dir / 'paths.json').write_text('{"a.txt": "0"}')
+        (_orig_dir / 'objects').mkdir()
+        (_orig_dir / 'objects' / '0').write_text('object')
+        m = Manifest.generate(_orig_dir)
+        target = Manifest(self._tmpdir / settings.MANIFEST_NAME, manifest={}, root=self._tmpdir)
+
+        plain_zip, dedupe_zip = self._tmpdir / 'plain.zip', self._tmpdir / 'dedupe.zip'
+        m.pzip(target, plain_zip)
+        m.pzip(target, dedupe_zip, dedupe=True)
+        with zipfile.ZipFile(str(plain_zip)) as z:
+            self.assertEqual(z.comment, b'')
+        with zipfile.ZipFile(str(dedupe_zip)) as z:
+            names = z.namelist()
+            self.assertEqual(z.comment, core.DEDUPE_COMMENT)
+            self.assertEqual(json.loads(z.read(core.PATHS_NAME)), m.manifest)
+        # Each unique file content is stored once
+        self.assertEqual(sorted(n for n in names if n.startswith(core.OBJECTS_DIR + '/')),
+                         sorted(f'{core.OBJECTS_DIR}/{h}' for h in set(m.manifest.values())))
+
+        # Both layouts extract to the original files
+        for zip_file in (plain_zip, dedupe_zip):
+            extract_dir = self._tmpdir / zip_file.stem
+            Manifest.punzip(zip_file, extract_dir)
+            self.assertEqual(Manifest.generate(extract_dir).manifest, m.manifest)
+            self.assertEqual((extract_dir / 'sub' / 'c.txt').read_text(), 'duplicate')
+            self.assertEqual((extract_dir / 'paths.json').read_text(), '{"a.txt": "0"}')
+
+    def test_punzip_unsafe_paths(self):
+        extract_dir = self._tmpdir / 'extract' / 'target'
+        for name in ('../escaped.txt', 'a/../../escaped.txt', '/abs.txt', 'C:/drive.txt', '..\\escaped.txt'):
+            with self.subTest(name=name):
+                zip_file = self._tmpdir / 'unsafe.zip'
+                with zipfile.ZipFile(str(zip_file), 'w') as z:
+                    z.writestr('safe.txt', 'safe')
+                    z.writestr(name, 'unsafe')
+                with self.assertRaises(ValueError):
+                    Manifest.punzip(zip_file, extract_dir)
+                # Nothing is extracted from an unsafe zip
+                self.assertFalse(extract_dir.exists())
+
+        # Deduplicated zips take the file paths from the paths mapping
+        zip_file = self._tmpdir / 'unsafe_dedupe.zip'
+        with zipfile.ZipFile(str(zip_file), 'w') as z:
+            z.writestr(f'{core.OBJECTS_DIR}/hash', 'unsafe')
+            z.writestr(core.PATHS_NAME, json.dumps({'../../escaped2.txt': 'hash'}))
+            z.comment = core.DEDUPE_COMMENT
+        with self.assertRaises(ValueError):
+            Manifest.punzip(zip_file, extract_dir)
+        self.assertFalse((self._tmpdir / 'escaped2.txt').exists())
+        self.assertEqual(Manifest._extract_target('/', 'a/b.txt'), '/a/b.txt')
+        self.assertEqual(Manifest._extract_target('bucket/dir', './a//b.txt'), 'bucket/dir/a/b.txt')
+
+    def test_tree_order(self):
+        paths = ['b/x.txt', 'a.txt', 'a/z.txt', 'b.txt', 'a/b/c.txt', 'a/y.txt']
+        self.assertEqual(sorted(paths, key=core.tree_order),
+                         ['a.txt', 'b.txt', 'a/y.txt', 'a/z.txt', 'a/b/c.txt', 'b/x.txt'])
+        entries = [(path, path) for path in sorted(paths, key=core.tree_order)]
+        with mock.patch.object(core, '_CAT_BATCH', 1):
+            self.assertEqual(len(list(Manifest._directory_batches(entries))), 6)
+        # Batches never mix directories
+        self.assertEqual([[file for _, file in batch] for batch in Manifest._directory_batches(entries)],
+                         [['a.txt', 'b.txt'], ['a/y.txt', 'a/z.txt'], ['a/b/c.txt'], ['b/x.txt']])
+
+    def test_generate_workers(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        # Hashing inline and on a thread pool give the same manifest
+        with mock.patch.object(core, 'ThreadPoolExecutor', wraps=core.ThreadPoolExecutor) as executor:
+            serial = Manifest.generate(_orig_dir, workers=1)
+            executor.assert_not_called()
+            parallel = Manifest.generate(_orig_dir, workers=4)
+            executor.assert_called_once()
+        self.assertEqual(serial.manifest, parallel.manifest)
+        self.assertEqual(list(serial.manifest), list(parallel.manifest))
+        self.assertEqual(parallel.manifest, pristine_manifest())
+
+    def test_json_backends(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        m = Manifest.generate(_orig_dir, _orig_dir / settings.MANIFEST_NAME)
+
+        # The stdlib json fallback and orjson (when installed) read and write the same documents
+        with mock.patch.object(core, 'orjson', None):
+            m.save()
+            self.assertEqual(Manifest(_orig_dir).manifest, m.manifest)
+            _data = (_orig_dir / settings.MANIFEST_NAME).read_bytes()
+        m.save()
+        self.assertEqual(Manifest(_orig_dir).manifest, m.manifest)
+        self.assertEqual(_data, (_orig_dir / settings.MANIFEST_NAME).read_bytes())
+        # Keys are sorted
+        self.assertEqual(list(json.loads(_data)), sorted(m.manifest))
+
+        # The document is written with a single call
+        from fsspec.implementations.local import LocalFileOpener
+        for backend in (None, core.orjson):
+            with mock.patch.object(core, 'orjson', backend), \
+                    mock.patch.object(LocalFileOpener, 'write', autospec=True,
+                                      side_effect=LocalFileOpener.write) as write:
+                m.save()
+            self.assertIn(write.call_count, (1, 2))
+            self.assertEqual(Manifest(_orig_dir).manifest, m.manifest)
+
+    @unittest.skipIf(core.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        _orig_dir = self._tmpdir / 'orig_files'
+        self.copy_test_files(_orig_dir)
+        _manifest_file = self._tmpdir / '.manifest.msgpack'
+        m = Manifest.generate(_orig_dir, _manifest_file)
+        self.assertEqual(m.manifest, pristine_manifest())
+
+        # The same manifest round trips through the binary format
+        with _manifest_file.open('rb') as fp:
+            self.assertEqual(core.msgpack.unpackb(fp.read(), raw=False), Manifest._serialize(m.manifest, m.stats))
+        m2 = Manifest(_manifest_file, root=_orig_dir)
+        self.assertEqual(m2.manifest, m.manifest)
+        self.assertEqual(m2.changed(), NO_CHANGES)
+        m2.save()
+        self.assertEqual(Manifest(_manifest_file).manifest, m.manifest)
+
+        _manifest_file.write_bytes(b'bad msgpack')
+        m2.load()
+        self.assertEqual(m2.manifest, {})
+        with mock.patch.object(core, 'msgpack', None):
+            with self.assertRaises(ImportError):
+                m2.load()
+
     def test_ignore(self):
         _copy_dir = self._tmpdir / 'test_files'
         self.copy_test_files(_copy_dir)
 
-        m = Manifest.generate(str(_copy_dir), str(_copy_dir / settings.MANIFEST_NAME))
+        m = Manifest.generate(_copy_dir, _copy_dir / settings.MANIFEST_NAME)
         self.assertFalse(settings.MANIFEST_NAME in m.manifest)
         m.refresh()
         self.assertFalse(settings.MANIFEST_NAME in m.manifest)
@@ -250,7 +576,7 @@ class ManifestlyManifestTestCase(unittest.TestCase):
         source.rm(path)
         self.assertFalse(source.exists(path))
 
-        m2 = Manifest(str(_copy_dir))
+        m2 = Manifest(_copy_dir)
         m2.refresh()
         self.assertTrue(m2.manifest)
 
@@ -260,36 +586,194 @@ class ManifestlyManifestTestCase(unittest.TestCase):
         self.assertTrue('subdirectory/ignore_me.md' in m2)
         self.assertTrue('subdirectory/dir_ignore/also_should_be_ignored.py' in m2)
 
+    def test_calculate_hash(self):
+        import hashlib
+        # New hashers are independent copies of a cached prototype
+        first, second = core.new_hasher('sha256'), core.new_hasher('sha256')
+        first.update(b'content')
+        self.assertEqual(second.hexdigest(), hashlib.sha256().hexdigest())
+        self.assertEqual(first.hexdigest(), hashlib.sha256(b'content').hexdigest())
+        self.assertEqual(core._HASHER_PROTOTYPES['sha256'].hexdigest(), hashlib.sha256().hexdigest())
+
+        _file = self.manifest_dir / 'test_binary' / 'random_binary.bin'
+        expected = hashlib.sha256(_file.read_bytes()).hexdigest()
+        local = fsspec.filesystem('file')
+        # Memory mapped, read in chunks and text mode OpenFile objects all hash the raw bytes
+        with mock.patch.object(settings, 'MMAP_THRESHOLD', 1):
+            self.assertEqual(Manifest.calculate_hash(local.open(str(_file))), expected)
+        with mock.patch.object(settings, 'MMAP_THRESHOLD', 0):
+            self.assertEqual(Manifest.calculate_hash(local.open(str(_file))), expected)
+        self.assertEqual(Manifest.calculate_hash(fsspec.open(str(_file), 'r')), expected)
+
+        # Python < 3.11 reads into a reused buffer, file-like objects without readinto use read
+        with mock.patch.object(settings, 'MMAP_THRESHOLD', 0), mock.patch.object(settings, 'CHUNK_SIZE', 7):
+            # Remove file_digest where it exists (Python >= 3.11), patch.dict restores it afterwards
+            with mock.patch.dict(core.hashlib.__dict__):
+                core.hashlib.__dict__.pop('file_digest', None)
+                self.assertEqual(Manifest.calculate_hash(local.open(str(_file))), expected)
+            with _file.open('rb') as f:
+                self.assertEqual(Manifest._hash_fileobj(mock.Mock(read=f.read, spec=['read']), 'sha256'), expected)
+
+        # Local paths are hashed memory mapped, with a single read or in chunks depending on their size
+        for mmap_threshold, chunk_size in ((1, 1024 * 1024), (0, 1024 * 1024), (0, 7)):
+            with mock.patch.object(settings, 'MMAP_THRESHOLD', mmap_threshold), \
+                    mock.patch.object(settings, 'CHUNK_SIZE', chunk_size):
+                self.assertEqual(Manifest._hash_path(local, str(_file)), expected)
+        # Both local code paths share the threshold check of _hash_mmap
+        with _file.open('rb') as f, mock.patch.object(settings, 'MMAP_THRESHOLD', _file.stat().st_size + 1):
+            self.assertIsNone(Manifest._hash_mmap(f.fileno(), _file.stat().st_size))
+            self.assertEqual(Manifest._hash_mmap(f.fileno(), _file.stat().st_size + 1), expected)
+
+    @unittest.skipIf(core.blake3 is None, 'blake3 is not installed')
+    def test_blake3(self):
+        _copy_dir = self._tmpdir / 'test_files'
+        self.copy_test_files(_copy_dir)
+        _file = _copy_dir / 'test_binary' / 'random_binary.bin'
+        expected = core.blake3.blake3(_file.read_bytes()).hexdigest()
+
+        m = Manifest.generate(_copy_dir, hash_algorithm='blake3')
+        self.assertEqual(m.manifest['test_binary/random_binary.bin'], expected)
+        self.assertEqual(Manifest.calculate_hash(fsspec.open(str(_file)), algorithm='blake3'), expected)
+
+    def test_remote_md5(self):
+        import base64
+        import hashlib
+        md5 = hashlib.md5(b'content').hexdigest()
+        self.assertEqual(Manifest.remote_md5({'md5Hash': base64.b64encode(bytes.fromhex(md5)).decode()}), md5)
+        self.assertIsNone(Manifest.remote_md5({'ETag': f'"{md5}"'}))
+        with mock.patch.object(settings, 'TRUST_ETAG', True):
+            self.assertEqual(Manifest.remote_md5({'ETag': f'"{md5}"'}), md5)
+            # Multipart upload
+            self.assertIsNone(Manifest.remote_md5({'ETag': f'"{md5[:30]}-2"'}))
+
+        # Reported checksums are used instead of reading the files
+        memory, remote = self.memory_dir()
+        memory.pipe({f'{remote}/a.txt': b'content', f'{remote}/b.txt': b'other'})
+        files = {'a.txt': f'{remote}/a.txt', 'b.txt': f'{remote}/b.txt'}
+        infos = {'a.txt': {'md5Hash': base64.b64encode(b'0' * 16).decode()}, 'b.txt': {}}
+        hashes = Manifest.hash_files(memory, files, algorithm='md5', infos=infos)
+        self.assertEqual(hashes, {'a.txt': (b'0' * 16).hex(), 'b.txt': hashlib.md5(b'other').hexdigest()})
+
+    def test_hash_files(self):
+        import hashlib
+        memory, remote = self.memory_dir()
+        contents = {f'{remote}/{i}.txt': str(i).encode() for i in range(40)}
+        contents[f'{remote}/large.bin'] = b'0' * 64
+        memory.pipe(contents)
+        files = {path.rsplit('/', 1)[-1]: path for path in contents}
+        infos = {name: memory.info(path) for name, path in files.items()}
+        expected = {name: hashlib.sha256(contents[path]).hexdigest() for name, path in files.items()}
+        with mock.patch.object(settings, 'CHUNK_SIZE', 16), mock.patch.object(settings, 'HASH_WORKERS', 4), \
+                mock.patch.object(Manifest, '_hash_small_files', wraps=Manifest._hash_small_files) as small:
+            hashes = Manifest.hash_files(memory, files, infos=infos)
+        # Small files are hashed in batches, the large file on its own
+        self.assertEqual(small.call_count, 2)
+        self.assertEqual(hashes, expected)
+        self.assertEqual(list(hashes), list(files))
+
+    def test_copy_file(self):
+        local = fsspec.filesystem('file')
+        memory, remote = self.memory_dir()
+        source = self.manifest_dir / 'test_binary' / 'random_binary.bin'
+
+        # Local to local
+        target = self._tmpdir / 'random_binary.bin'
+        Manifest.copy_file(local, str(source), local, str(target))
+        self.assertEqual(target.read_bytes(), source.read_bytes())
+
+        # Streamed between filesystems
+        Manifest.copy_file(local, str(source), memory, f'{remote}/random_binary.bin')
+        self.assertEqual(memory.cat(f'{remote}/random_binary.bin'), source.read_bytes())
+
+        # Copied by the filesystem itself
+        Manifest.copy_file(memory, f'{remote}/random_binary.bin', memory, f'{remote}/copy.bin')
+        self.assertEqual(memory.cat(f'{remote}/copy.bin'), source.read_bytes())
+
+        target = self._tmpdir / 'copy.bin'
+        Manifest.copy_file(memory, f'{remote}/copy.bin', local, str(target))
+        self.assertEqual(target.read_bytes(), source.read_bytes())
+
+        # Streamed between two remote filesystems
+        with mock.patch.object(Manifest, 'open_sequential', wraps=Manifest.open_sequential) as open_sequential:
+            Manifest.copy_file(memory, f'{remote}/copy.bin', mock.Mock(wraps=memory), f'{remote}/streamed.bin')
+            open_sequential.assert_called_once()
+        self.assertEqual(memory.cat(f'{remote}/streamed.bin'), source.read_bytes())
+
+    def test_sync_glob_names(self):
+        # File names with glob characters (e.g. Next.js pages/[id].tsx) are copied as they are, not expanded
+        memory, remote = self.memory_dir()
+        memory.pipe({f'{remote}/src/pages/[id].tsx': b'id', f'{remote}/src/pages/d.tsx': b'd',
+                     f'{remote}/src/[ab].txt': b'ab'})
+        source = Manifest.generate(f'memory://{remote}/src')
+        source.root = f'memory://{remote}/src'
+        target = Manifest(f'memory://{remote}/dst/{settings.MANIFEST_NAME}')
+        source.sync(target)
+        self.assertEqual(memory.cat_file(f'{remote}/dst/pages/[id].tsx'), b'id')
+        self.assertEqual(memory.cat_file(f'{remote}/dst/[ab].txt'), b'ab')
+        self.assertFalse(memory.isdir(f'{remote}/dst/pages/[id].tsx'))
+        self.assertEqual(Manifest.generate(f'memory://{remote}/dst').manifest, source.manifest)
+
+        # Removing a bracketed name does not remove the files its pattern matches
+        memory.pipe({f'{remote}/src/pages/i.tsx': b'i', f'{remote}/dst/pages/i.tsx': b'i'})
+        memory.rm_file(f'{remote}/src/pages/[id].tsx')
+        source = Manifest.generate(f'memory://{remote}/src')
+        source.root = f'memory://{remote}/src'
+        target.manifest = Manifest.generate(f'memory://{remote}/dst').manifest
+        source.sync(target)
+        self.assertFalse(memory.exists(f'{remote}/dst/pages/[id].tsx'))
+        self.assertEqual(memory.cat_file(f'{remote}/dst/pages/d.tsx'), b'd')
+        self.assertEqual(memory.cat_file(f'{remote}/dst/pages/i.tsx'), b'i')
+
+    def test_copy_files_errors(self):
+        local = fsspec.filesystem('file')
+        source = self.manifest_dir / 'test_css.css'
+        copies = [(str(source), str(self._tmpdir / 'copy.css')),
+                  (str(self.manifest_dir / 'missing.css'), str(self._tmpdir / 'missing.css'))]
+        # The failing copy is raised, but the other copies still complete
+        with self.assertRaises(FileNotFoundError):
+            Manifest._copy_files(local, local, copies)
+        self.assertEqual((self._tmpdir / 'copy.css').read_bytes(), source.read_bytes())
+
+        # A single copy is made without a thread pool and raised directly
+        with mock.patch.object(core, 'ThreadPoolExecutor') as executor:
+            with self.assertRaises(FileNotFoundError):
+                Manifest._copy_files(local, local, copies[1:])
+            executor.assert_not_called()
+
     def test_bad_manifest(self):
         _orig_dir = self._tmpdir / 'orig_files'
         self.copy_test_files(_orig_dir)
 
-        m1 = Manifest.generate(str(_orig_dir), str(_orig_dir / settings.MANIFEST_NAME))
+        m1 = Manifest.generate(_orig_dir, _orig_dir / settings.MANIFEST_NAME)
         m1.save()
-        _manifest_file = m1._reopen()
-        self.assertEqual(m1.manifest, json.loads(_manifest_file.open().read()))
-
-        # Corrupt the manifest
-        m1._reopen('w').open().write('bad json')
-        m1.load()
-        self.assertEqual(m1.manifest, {})
-
-        m1._reopen('w').open().write('')
-        m1.load()
-        self.assertEqual(m1.manifest, {})
+        with m1._reopen('rb') as fp:
+            self.assertEqual(Manifest._serialize(m1.manifest, m1.stats), json.load(fp))
+
+        # The files are hashed once, every corruption starts from the valid manifest
+        manifest = m1.manifest
+        for corruption in ('bad json', '', '[1, 2]', '"x"', 'null', '{"a": {"size": 1}}'):
+            with self.subTest(corruption=corruption):
+                m1.manifest = dict(manifest)
+                m1.save()
+                # Corrupt the manifest
+                with m1._reopen('w') as fp:
+                    fp.write(corruption)
+                m1.load()
+                self.assertEqual(m1.manifest, {})
+                self.assertEqual(m1.stats, {})
 
 
 class TestManifestlyIgnore(unittest.TestCase):
 
+    @pytest.fixture(autouse=True)
+    def _tmp_dirs(self, tmp_path):
+        self._tmpdir = tmp_path
+
     def setUp(self):
-        self._tmpdir = pathlib.Path(tempfile.mkdtemp())
         self.manifest_dir = pathlib.Path(__file__).parent / 'test_files'
 
-    def tearDown(self):
-        shutil.rmtree(str(self._tmpdir))
-
     def test_manifestly_ignore(self):
-        ignore_file = Manifest.default_ignore_file(str(self.manifest_dir))
+        ignore_file = Manifest.default_ignore_file(self.manifest_dir)
         # Test if the OpenFile exists
         source, path = fsspec.core.url_to_fs(ignore_file.path)
         self.assertTrue(source.exists(path))
@@ -300,9 +784,17 @@ class TestManifestlyIgnore(unittest.TestCase):
         self.assertTrue(_ignore.ignore_patterns)
         self.assertIn('.DS_Store', _ignore.ignore_patterns)
 
+    def test_manifestly_ignore_comments(self):
+        ignore_file = self._tmpdir / settings.MANIFESTLY_IGNORE
+        ignore_file.write_bytes(b'# Build output\r\nbuild/\r\n\r\n  \n*.pyc\n')
+        _ignore = ManifestlyIgnore(ignore_file)
+        self.assertEqual(_ignore.ignore_patterns, [settings.MANIFEST_NAME, 'build/', '*.pyc'])
+        self.assertFalse(_ignore.should_ignore('src/file.py'))
+        self.assertTrue(_ignore.should_ignore('build/file.py'))
+
     def test_manifestly_ignore_dne(self):
         tmp_dir = self._tmpdir
-        ignore_file = Manifest.default_ignore_file(str(tmp_dir))
+        ignore_file = Manifest.default_ignore_file(tmp_dir)
         # Create the Manifestly Ignore object
         _ignore = ManifestlyIgnore(ignore_file.path)
         self.assertTrue(_ignore)
@@ -319,6 +811,24 @@ class TestManifestlyIgnore(unittest.TestCase):
         self.assertTrue(_ignore.should_ignore('test_dir/test_file.txt'))
         self.assertTrue(_ignore.should_ignore('test_dir/', ))
 
-
-if __name__ == '__main__':
-    unittest.main()  # pragma: no cover
+        # Glob patterns
+        _ignore.add_ignore_pattern('*.pyc')
+        self.assertTrue(_ignore.should_ignore('src/module/file.pyc'))
+        self.assertFalse(_ignore.should_ignore('src/module/file.py'))
+        _ignore.add_ignore_pattern('build_[0-9]/')
+        self.assertTrue(_ignore.should_ignore('build_1/output.txt'))
+        self.assertFalse(_ignore.should_ignore('build_x/output.txt'))
+
+        # Directory decisions are cached, adding a pattern resets the cache
+        self.assertFalse(_ignore.should_ignore('cache_dir/nested/file.txt'))
+        _ignore.add_ignore_pattern('nested')
+        self.assertTrue(_ignore.should_ignore('cache_dir/nested/file.txt'))
+        self.assertTrue(_ignore.should_ignore('/abs/cache_dir/nested/deeper/file.txt'))
+
+        # Changing or replacing ignore_patterns directly is picked up as well
+        self.assertFalse(_ignore.should_ignore('a/b.log'))
+        _ignore.ignore_patterns.append('*.log')
+        self.assertTrue(_ignore.should_ignore('a/b.log'))
+        _ignore.ignore_patterns = _ignore.load_ignore_patterns()
+        self.assertFalse(_ignore.should_ignore('a/b.log'))
+        self.assertFalse(_ignore.should_ignore('cache_dir/nested/file.txt'))